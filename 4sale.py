@@ -1,13 +1,16 @@
-from playwright.async_api import Playwright, async_playwright
+from playwright.async_api import Browser, async_playwright
 import asyncio
 import re
-import time
 import json
 from datetime import datetime
 import safe_scrape as ss
+import html_archive
+import parsers
+from scrape_sink import JsonlSink, write_pages_in_order
+from crawl_state import Checkpoint, IncrementalCrawl, SeenIndex, write_new_page
 import random
 import logging
-import uuid
+from urllib.parse import urljoin, urlparse
 
 # Setup logging to both file and console
 
@@ -57,6 +60,30 @@ cars_dict = {
 'infiniti':'https://www.q84sale.com/en/automotive/cars/1/infiniti-?c=524'
             }
 
+# number of brands scraped at the same time, each one in its own browser context
+max_concurrency = 3
+# 'url' opens pages directly by number in parallel tabs, 'click' follows the next button;
+# 'url' falls back to 'click' for a brand whose next link doesn't number its pages in the url
+pagination_mode = 'url'
+# number of tabs fetching pages of one brand at the same time in 'url' mode,
+# it adapts to the site between 1 and max_page_concurrency
+page_concurrency = 3
+max_page_concurrency = 6
+# attempts after the first one for a page that timed out, was throttled or came back empty
+retries = 3
+# skip images, fonts, media and trackers, see safe_scrape.ResourcePolicy
+block_resources = True
+# None, 'gzip' or 'zstd' for the per brand JSON Lines output
+output_compression = None
+# only write listings not seen in earlier runs and stop paginating once
+# stop_after_known_pages pages in a row had nothing new (crawl_state.db)
+incremental = False
+stop_after_known_pages = 1
+# save progress after every page and pick up unfinished brands where they stopped
+resume = True
+# store the html of every listing page in the content-addressed archive
+archive_html = True
+
 user_agents = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
     'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15',
@@ -66,68 +93,87 @@ user_agents = [
 
 user_agent = random.choice(user_agents)
 
-def extract_number(text):
-    try:
-        if text is None:
-            return None
-        else:
-        # Split and take first part, replace comma with dot
-            cleaned = text.replace(',', '').split()[0]
-            return float(cleaned)
-    except (ValueError, IndexError):
+# Pulls the raw text of every listing card in the browser, returns plain dicts
+CARD_FIELDS_JS = """
+cards => cards.map(card => {
+    const text = (selector) => {
+        const el = card.querySelector(selector);
+        return el ? el.textContent : null;
+    };
+    return {
+        model: text('.text-6-med.text-neutral_600'),
+        properties: text('.styles_attr___ur_q'),
+        price: text('.h6.text-prim_4sale_500'),
+        url: card.getAttribute('href')
+    };
+})
+"""
+
+
+# 'dom' reads the rendered listing cards, 'json' reads the listing payload the
+# site ships to the browser (embedded __NEXT_DATA__ or the XHR behind pagination)
+extraction_mode = 'dom'
+
+EMBEDDED_STATE_JS = """
+() => {
+    const el = document.getElementById('__NEXT_DATA__');
+    return el ? el.textContent : null;
+}
+"""
+
+
+class ListingCapture:
+    """Keeps the listing payloads the page fetches while we paginate."""
+
+    def __init__(self):
+        self.payloads = []
+        self.received = asyncio.Event()
+
+    async def on_response(self, response):
+        if response.request.resource_type not in ('xhr', 'fetch'):
+            return
+        if 'json' not in (response.headers.get('content-type') or ''):
+            return
+        try:
+            data = await response.json()
+        except Exception:
+            return
+        if parsers.find_listings(data):
+            self.payloads.append(data)
+            self.received.set()
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.received.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def drain(self):
+        payloads, self.payloads = self.payloads, []
+        self.received.clear()
+        return payloads
+
+
+async def extract_json_page(page, capture, brand, page_num, previous_ids):
+    # returns None when no usable payload is found so the caller can fall back to the DOM
+    payloads = capture.drain()
+    if not payloads:
+        await page.wait_for_load_state('load')
+        embedded = await page.evaluate(EMBEDDED_STATE_JS)
+        payloads = [json.loads(embedded)] if embedded else []
+
+    listings = []
+    for payload in payloads:
+        listings.extend(parsers.find_listings(payload))
+    if not listings:
         return None
 
-def is_two_digits(number):
-    try:
-        if number is None:
-            return None
-        else:
-            abs_num = abs(number)
-            # Check if between 100 and 999
-            return 10 <= abs_num <= 100
-    except (ValueError, IndexError):
+    ids = [str(listing.get('id') or listing.get('slug')) for listing in listings]
+    if ids == previous_ids:
+        # client side navigation leaves the old __NEXT_DATA__ in place
         return None
-
-
-
-def mileage_processor(mileage):
-    if mileage is None:
-        return False, None
-    
-    # First try to match number followed by standalone 'k'
-    k_pattern = r'(\d+(?:\.\d+)?)\s*\b[kK]\b'
-    k_match = re.search(k_pattern, mileage)
-    
-    if k_match:
-        return 'k', float(k_match.group(1))
-    
-    # If no 'k' match, try to match number followed by 'km'
-    km_pattern = r'(\d+(?:\.\d+)?)\s*(?:km|KM|Km|kM)'
-    km_match = re.search(km_pattern, mileage)
-    
-    if km_match:
-        return 'km', float(km_match.group(1))
-    
-    # If no 'k' or 'km' match, try to match just a number
-    number_pattern = r'^\s*(\d+(?:\.\d+)?)\s*$'
-    number_match = re.search(number_pattern, mileage)
-    
-    if number_match:
-        return False, float(number_match.group(1))
-    
-    return False, None
-
-def to_json_file(data, filename):
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            file_data = json.load(f)
-    except:
-        file_data = []
-    
-    file_data.append(data)
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(file_data, f, indent=4)
-    return filename
+    previous_ids[:] = ids
+    return [parsers.parse_4sale_listing(listing, brand, page_num) for listing in listings]
 
 
 async def check_last_page(page):
@@ -151,116 +197,140 @@ async def check_last_page(page):
         return False
 
 
-async def run(playwright: Playwright, url: str, brand: str):
-    browser = await playwright.chromium.launch(headless=False)
-    context = await browser.new_context(viewport={"width": 1600, "height": 900},
-                                user_agent=user_agent,
-                                locale='en-US',
-                                timezone_id='America/New_York'
-                                #geolocation={'longitude': 59.913034295248146, 'latitude':  10.760390096262885},
-                                #permissions=['geolocation']
-                                )
-    page = await context.new_page()
-    #await context.clear_permissions()
-    #await context.clear_cookies()
+# the number segment of listing urls like /automotive/cars/1/cadillac?c=520, taken for the
+# page number only once the site's own next link confirms it (see last_page_number)
+PAGE_IN_URL = re.compile(r'(/automotive/cars/)(\d+)(/)')
 
-    
-    await page.goto(url,  timeout=60000, wait_until='load')
-    
-    car_list = []
-    page_num = 1
-    
-    logger.info("\nScraping page %d - %s", page_num, page.url)
-    #print(f"\nScraping page {page_num} - {page.url}")
-    
-    # Process cars on current page
-    #for brand, url in cars_dict.items():
-    cars_scraped = 0
-    while True:
-        await page.wait_for_selector('.StackedCard_card__Kvggc', state='visible', timeout=30000)
-        cars = await page.query_selector_all('.StackedCard_card__Kvggc')
+PAGE_LINKS_JS = "links => links.map(link => link.href)"
+NEXT_LINK = 'a[data-test="type_next"]:not(.styles_disabled__O4kp4)'
 
-        
-        logger.info("Found %d cars on page %d for brand %s", len(cars), page_num, brand)
-        #print(f"Found {len(cars)} cars on page {page_num} for brand {brand}")
 
+def page_url(url, page_num):
+    return PAGE_IN_URL.sub(lambda m: f'{m.group(1)}{page_num}{m.group(3)}', url, count=1)
 
-        for car in cars:
-            
-            model = await car.query_selector('.text-6-med.text-neutral_600')
-            model = await model.text_content() if model else "NA"
 
-            car_properties = await car.query_selector('.styles_attr___ur_q')
-            car_properties = await car_properties.text_content() if car_properties else 'NA'
+async def last_page_number(page, url, page_num=1):
+    # returns None when the site does not expose the page number in the url: the next link
+    # of page page_num has to be this listing with page_num + 1 in the number segment,
+    # otherwise the segment is something else and every url would load the same page
+    if not PAGE_IN_URL.search(url):
+        return None
+    listing_path = urlparse(page_url(url, 0)).path
+    next_link = await page.query_selector(NEXT_LINK)
+    next_href = urljoin(page.url, await next_link.get_attribute('href') or '') if next_link else ''
+    next_page = PAGE_IN_URL.search(next_href)
+    if (next_page is None or int(next_page.group(2)) != page_num + 1
+            or urlparse(page_url(next_href, 0)).path != listing_path):
+        logger.info('Next link %r does not number the pages in the url, following it instead', next_href or None)
+        return None
+    hrefs = await page.eval_on_selector_all('a[href*="/automotive/cars/"]', PAGE_LINKS_JS)
+    page_numbers = [int(PAGE_IN_URL.search(href).group(2)) for href in hrefs
+                    if PAGE_IN_URL.search(href) and urlparse(page_url(href, 0)).path == listing_path]
+    last_page = max(page_numbers, default=1)
+    return last_page if last_page > 1 else None
 
-            price = await car.query_selector('.h6.text-prim_4sale_500')
-            price = await price.text_content() if price else 'NA'
 
-            link = await car.get_attribute('href')
-            
-            if len(car_properties.split(',')) > 1 and len(car_properties.split(',')) < 4:
-                has_k, mileage_proc = mileage_processor(car_properties.split(',')[1].strip().replace(',', ''))
-            elif len(car_properties.split(',')) == 4:
-                has_k, mileage_proc = mileage_processor(car_properties.split(',')[1].strip().replace(',', '') + car_properties.split(',')[2].strip().replace(',', ''))
-            else:
-                continue
-            
-            year_text = car_properties.split(',')[0].strip()
-            year_value = 1970 if year_text == 'Before 1980' else year_text
-
-            if has_k == 'k' or (has_k == 'km' and len(str(mileage_proc)) == 4  
-                                                    and datetime.now().year - int(year_value) > 0):
-                mileage = mileage_proc * 1000
-            elif has_k == 'k' or (has_k == 'km' and int(mileage_proc)/1000 < 1000
-                                                    and datetime.now().year - int(year_value) > 0):
-                mileage = mileage_proc * 100
-            else:
-                mileage = None
-                #mileage = mileage.split(',')[1].strip().replace(',', '')
+async def extract_page(page, capture, brand, page_num, previous_ids):
+    cars = None
+    if extraction_mode == 'json':
+        cars = await extract_json_page(page, capture, brand, page_num, previous_ids)
+        if cars is None:
+            logger.warning('No listing payload on page %d for brand %s, reading the cards instead', page_num, brand)
 
-            current_datetime = datetime.now()
-            timestamp = current_datetime.strftime('%Y-%m-%d %H:%M:%S')
+    if cars is None:
+        await page.wait_for_selector('.StackedCard_card__Kvggc', state='visible', timeout=30000)
+        # one round trip for the whole page instead of several awaits per card
+        cards = await page.eval_on_selector_all('.StackedCard_card__Kvggc', CARD_FIELDS_JS)
+        if not cards:
+            raise ss.EmptyPage(f'no cards on page {page_num} for brand {brand}')
+        cars = [parsers.parse_4sale_card(card, brand, page_num) for card in cards]
 
-            if is_two_digits(extract_number(price)) is None:
-                price = None
-            elif is_two_digits(extract_number(price)):
-                price = extract_number(price) * 1000
-            else:
-                price = extract_number(price)
+    if archive_html:
+        # kept so the page can be re-parsed later without scraping it again
+        html_archive.default_archive().store(await page.content(), 'q84sale', brand, page_num, page.url)
 
+    logger.info("Found %d cars on page %d for brand %s", len(cars), page_num, brand)
+    #print(f"Found {len(cars)} cars on page {page_num} for brand {brand}")
+    return [car_info for car_info in cars if car_info is not None]
 
-            if len(car_properties.split(',')) == 3:
-                color = car_properties.split(',')[2].strip()
-            elif len(car_properties.split(',')) == 2:
-                color = car_properties.split(',')[1].strip()
-            elif len(car_properties.split(',')) == 1:
-                color = None
-            else:
-                color = car_properties.split(',')[3].strip()
-            
-            car_info = {
-                'uuid': str(uuid.uuid4()),
-                'url': link,
-                'brand': brand,
-                'page': page_num,
-                'timestamp': timestamp,
-                'model': model.strip(),
-                'year': year_value, #year.split(',')[0].strip(),
-                'mileage': mileage,
-                'color': color,#car_properties.split(',')[2].strip(),
-                'price': price #extract_number(price) #extract_number(price) * 1000 if isinstance(extract_number(price), float) else extract_number(price)
-            }
-            car_list.append(car_info)
-            
-        cars_scraped += len(cars)   
+
+async def new_listing_page(context):
+    page = await context.new_page()
+    capture = ListingCapture()
+    if extraction_mode == 'json':
+        page.on('response', capture.on_response)
+    return page, capture
+
+
+async def scrape_page(context, concurrency, url, brand, page_num, sink=None):
+    async def attempt():
+        page, capture = await new_listing_page(context)
+        try:
+            await ss.goto(page, page_url(url, page_num))
+            return await extract_page(page, capture, brand, page_num, [])
+        finally:
+            await page.close()
+
+    try:
+        cars = await ss.with_retries(attempt, retries, concurrency, f'{brand} page {page_num}')
+    except Exception as e:
+        # one bad page should not cost the rest of the brand
+        logger.error('Giving up on page %d for %s: %s', page_num, brand, e)
+        if sink:
+            sink.mark_incomplete(f'{brand} page {page_num} failed')
+        cars = []
+    return page_num, cars
+
+
+async def scrape_by_url(context, page, capture, url, brand, last_page, sink, crawl=None,
+                        first_page=1, on_page=None):
+    # first_page is already open, the rest fan out over a bounded set of tabs
+    cars_scraped = write_new_page(sink, await extract_page(page, capture, brand, first_page, []), crawl)
+    if on_page:
+        on_page(first_page)
+    concurrency = ss.AdaptiveConcurrency(page_concurrency, maximum=max_page_concurrency)
+    if crawl is None:
+        tasks = [scrape_page(context, concurrency, url, brand, n, sink) for n in range(first_page + 1, last_page + 1)]
+        cars_scraped += await write_pages_in_order(sink, tasks, first_page=first_page + 1, on_page=on_page)
+    else:
+        # incremental runs go one batch of tabs at a time so they can stop early
+        start = first_page + 1
+        while start <= last_page:
+            if crawl.should_stop:
+                logger.info('Only known listings for %s on the last %d pages, stopping', brand, crawl.known_pages)
+                break
+            batch = range(start, min(start + concurrency.limit, last_page + 1))
+            for page_num, cars in await asyncio.gather(*(scrape_page(context, concurrency, url, brand, n, sink)
+                                                         for n in batch)):
+                if not crawl.should_stop:
+                    cars_scraped += write_new_page(sink, cars, crawl)
+                    if on_page:
+                        on_page(page_num)
+            start = batch.stop
+    logger.info('total cars scraped for %s: %d over %d pages', brand, cars_scraped, last_page)
+    return cars_scraped
+
+
+async def scrape_by_click(page, capture, brand, sink, crawl=None, page_num=1, on_page=None, stop_page=None):
+    previous_ids = []
+    
+    # Process cars on current page
+    #for brand, url in cars_dict.items():
+    cars_scraped = 0
+    while True:
+        cars = await ss.with_retries(lambda: extract_page(page, capture, brand, page_num, previous_ids),
+                                     retries, description=f'{brand} page {page_num}')
+        cars_scraped += write_new_page(sink, cars, crawl)
+        if on_page:
+            on_page(page_num)
         logger.info('total cars scraped: %d', cars_scraped)
-        next_button = page.locator('a[data-test="type_next"]:not(.styles_disabled__O4kp4)')
-        
-        time.sleep(random.uniform(1.5,2.5))
 
-        x,y = ss.random_mouse_movement()
-        await page.mouse.move(x, y)
-        await page.wait_for_timeout(random.randint(300, 800))
+        if crawl and crawl.should_stop:
+            logger.info('Only known listings for %s on the last %d pages, stopping', brand, crawl.known_pages)
+            break
+        if stop_page and page_num >= stop_page:
+            break
+        next_button = page.locator('a[data-test="type_next"]:not(.styles_disabled__O4kp4)')
 
         print(str(await next_button.count()))
         
@@ -273,33 +343,126 @@ async def run(playwright: Playwright, url: str, brand: str):
             else:
                 break
 
-            x,y = ss.random_mouse_movement()
-            await page.mouse.move(x, y)
-            await page.wait_for_timeout(random.randint(300, 800))
-
             await next_button.scroll_into_view_if_needed()
-            
-            delay = ss.random_delay(1.5,3)
 
-            await page.wait_for_timeout(delay * 1000)
+            # waits for this host's turn without blocking the other brands
+            await ss.human_pause(page)
             await next_button.click()
+            if extraction_mode == 'json':
+                await capture.wait(timeout=5)
             
             page_num += 1
+    return cars_scraped
+
+
+async def click_through(page, pages):
+    # gets a resumed crawl back to its page when the url has no page number
+    for _ in range(pages):
+        next_button = page.locator('a[data-test="type_next"]:not(.styles_disabled__O4kp4)')
+        await next_button.wait_for(state='visible', timeout=5000)
+        await ss.human_pause(page)
+        await next_button.click()
+        await page.wait_for_load_state('load')
+
+
+async def run(browser: Browser, url: str, brand: str, sink: JsonlSink, seen_index: SeenIndex = None,
+              checkpoint: Checkpoint = None, start_page: int = 1, stop_page: int = None):
+    # records are written to sink page by page, returns how many were scraped
+    # pages start_page to stop_page are scraped, stop_page None means up to the last one
+    # with a seen_index only new listings are written and pagination stops early
+    # with a checkpoint progress is saved after every page, start_page resumes a crashed run
+    crawl = IncrementalCrawl(seen_index, 'q84sale', brand, stop_after_known_pages) if seen_index else None
+    if crawl:
+        sink.mark_incomplete(f'{brand}: incremental crawl, only new listings')
+    on_page = (lambda page_num: checkpoint.save('q84sale', brand, page_num, sink)) if checkpoint else None
+    start_url = page_url(url, start_page) if PAGE_IN_URL.search(url) else url
+    # every brand gets its own isolated context (cookies, storage) on the shared browser
+    context = await browser.new_context(viewport={"width": 1600, "height": 900},
+                                user_agent=user_agent,
+                                locale='en-US',
+                                timezone_id='America/New_York'
+                                #geolocation={'longitude': 59.913034295248146, 'latitude':  10.760390096262885},
+                                #permissions=['geolocation']
+                                )
+    policy = await ss.apply_resource_policy(context) if block_resources else None
+    try:
+        page, capture = await new_listing_page(context)
+        #await context.clear_permissions()
+        #await context.clear_cookies()
+
+        await ss.with_retries(lambda: ss.goto(page, start_url), retries, description=f'{brand} first page')
+        if start_url == url and start_page > 1:
+            await click_through(page, start_page - 1)
+        logger.info("\nScraping page %d - %s", start_page, page.url)
+        #print(f"\nScraping page {page_num} - {page.url}")
+
+        last_page = await last_page_number(page, url, start_page) if pagination_mode == 'url' else None
+        if last_page and stop_page:
+            last_page = min(last_page, stop_page)
+        if last_page and start_page > last_page:
+            logger.info('Nothing left to scrape for %s after page %d', brand, last_page)
+            cars_scraped = 0
+        elif last_page:
+            logger.info('Found %d pages for %s, fetching them %d at a time', last_page, brand, page_concurrency)
+            cars_scraped = await scrape_by_url(context, page, capture, url, brand, last_page, sink, crawl,
+                                               first_page=start_page, on_page=on_page)
+        else:
+            cars_scraped = await scrape_by_click(page, capture, brand, sink, crawl,
+                                                 page_num=start_page, on_page=on_page, stop_page=stop_page)
+    finally:
+        await context.close()
+        if policy:
+            logger.info('Resource policy for %s: %s', brand, policy.report())
+
+    return cars_scraped
+
+
+async def scrape_brand(browser: Browser, semaphore: asyncio.Semaphore, brand: str, url: str,
+                       seen_index: SeenIndex = None, checkpoint: Checkpoint = None):
+    async with semaphore:
+        filename = 'car_list_'+brand+'_'+str(timestamp)+'.jsonl'
+        if checkpoint:
+            sink, start_page = checkpoint.open_sink('q84sale', brand, filename, compression=output_compression)
+            if start_page > 1:
+                logger.info('Resuming %s from page %d into %s', brand, start_page, sink.filename)
+        else:
+            sink, start_page = JsonlSink(filename, compression=output_compression), 1
+
+        try:
+            result = await run(browser, url=url, brand=brand, sink=sink, seen_index=seen_index,
+                               checkpoint=checkpoint, start_page=start_page)
+        except Exception as e:
+            # one failing brand should not take down the others running next to it,
+            # the pages already written stay in the .part file for the next run to resume
+            logger.error('Scraping failed for %s: %s', brand, e, exc_info=True)
+            sink.mark_incomplete(f'{brand} failed: {e}')
+            sink.close(finished=checkpoint is None)
+            return None
 
-    to_json_file(car_list, 'car_list3.json')
-    await browser.close() 
-    return car_list
+        sink.close()
+        if checkpoint:
+            checkpoint.finish('q84sale', brand)
+        logger.info('Finished scraping for %s, %d cars written to %s', brand, sink.records_written, sink.filename)
+        return result
 
 
-async def main():
+async def main(concurrency: int = max_concurrency):
     # Use async_playwright to manage the Playwright instance
     try:
         async with async_playwright() as playwright:
-            for brand, url in cars_dict.items():
-                result = await run(playwright, url=url, brand=brand)
-                #print(result)
-                to_json_file(result, 'car_list_'+brand+'_'+str(timestamp)+'.json')
-                logger.info('Finished scraping for %s', brand)
+            browser = await playwright.chromium.launch(headless=False)
+            semaphore = asyncio.Semaphore(concurrency)
+            seen_index = SeenIndex() if incremental else None
+            checkpoint = Checkpoint() if resume else None
+            try:
+                await asyncio.gather(*(scrape_brand(browser, semaphore, brand, url, seen_index, checkpoint)
+                                       for brand, url in cars_dict.items()))
+            finally:
+                await browser.close()
+                if seen_index:
+                    seen_index.close()
+                if checkpoint:
+                    checkpoint.close()
     except Exception as e:
         logger.error(e, exc_info=True)
 
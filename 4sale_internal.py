@@ -1,7 +1,6 @@
 from playwright.async_api import Playwright, async_playwright
 import asyncio
 import re
-import time
 import json
 from datetime import datetime
 import safe_scrape as ss
@@ -31,17 +30,11 @@ urls = [
 
 car_details = []
 
-async def run(playwright: Playwright, url: str):
-    browser = await playwright.chromium.launch(headless=False)
-    page = await browser.new_page(viewport={"width": 1600, "height": 900},
-                                user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) Gecko/20100101 Firefox/132.0',
-                                locale='en-US',
-                                timezone_id='America/New_York',
-                                geolocation={'longitude': -74.006, 'latitude': 40.7128},
-                                permissions=['geolocation'])
-    
-    await page.goto(url=url,  timeout=60000, wait_until='load')
+# skip images, fonts, media and trackers, see safe_scrape.ResourcePolicy
+block_resources = True
 
+async def extract_details(page):
+    # page is already on a listing url, returns phone, description and specs
     await page.wait_for_selector('p.text-4-regular.m-text-5-regular.text-neutral_600')
     get_desc = page.locator('p.text-4-regular.m-text-5-regular.text-neutral_600')
     await get_desc.wait_for(state='visible', timeout=30000)
@@ -57,8 +50,9 @@ async def run(playwright: Playwright, url: str):
 
     car_specs_dict = {}
 
-    time.sleep(1)
     try:
+        # the number shows up once the click above is handled
+        await page.wait_for_selector('div.styles_phoneText__LmLHj.text-4-med.m-text-4-med.text-neutral_900', state='visible', timeout=5000)
         phone_no = await page.query_selector('div.styles_phoneText__LmLHj.text-4-med.m-text-4-med.text-neutral_900')
         phone_no = await phone_no.text_content()
 
@@ -82,9 +76,27 @@ async def run(playwright: Playwright, url: str):
         'car_specs':car_specs_dict
 
     }
-        car_details.append(internal_details)
+    return internal_details
+
+
+async def run(playwright: Playwright, url: str):
+    browser = await playwright.chromium.launch(headless=False)
+    page = await browser.new_page(viewport={"width": 1600, "height": 900},
+                                user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) Gecko/20100101 Firefox/132.0',
+                                locale='en-US',
+                                timezone_id='America/New_York',
+                                geolocation={'longitude': -74.006, 'latitude': 40.7128},
+                                permissions=['geolocation'])
+    policy = await ss.apply_resource_policy(page) if block_resources else None
+    
+    await page.goto(url=url,  timeout=60000, wait_until='load')
+
+    internal_details = await extract_details(page)
+    car_details.append(internal_details)
 
     await browser.close()
+    if policy:
+        logger.info('Resource policy for %s: %s', url, policy.report())
     return car_details
 
 
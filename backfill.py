@@ -0,0 +1,132 @@
+import argparse
+import glob
+import hashlib
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+import insert_into_db as db
+import market_views
+
+logger = logging.getLogger(__name__)
+
+# scrape output in all the shapes it has had: .json, .jsonl, compressed
+PATTERNS = ('car_list_*.json', 'car_list_*.jsonl', 'car_list_*.jsonl.gz', 'car_list_*.jsonl.zst')
+workers = 4
+# connections per worker: the COPY connection plus one for the manifest
+worker_pool_size = 2
+
+
+def find_files(sources):
+    # sources are files, globs or directories, returns each file once in a stable order
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            for pattern in PATTERNS:
+                files.extend(glob.glob(os.path.join(source, '**', pattern), recursive=True))
+        else:
+            files.extend(glob.glob(source))
+    # '.part' files are still being written or belong to a crashed run,
+    # '.run.json' files are the run info next to an output
+    return sorted({os.path.abspath(f) for f in files if not f.endswith(('.part', '.run.json'))})
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def loaded_digests():
+    with db.engine.connect() as connection:
+        rows = connection.execute(select(db.IngestManifest.sha256).where(db.IngestManifest.status == 'done'))
+        return {row[0] for row in rows}
+
+
+def record_file(digest, **values):
+    statement = insert(db.IngestManifest).values(sha256=digest, **values)
+    statement = statement.on_conflict_do_update(index_elements=[db.IngestManifest.sha256], set_=values)
+    with db.engine.begin() as connection:
+        connection.execute(statement)
+
+
+def init_worker():
+    db.use_engine(worker_pool_size)
+
+
+def load_file(path, digest, chunk_size, on_conflict):
+    # runs in a worker process, the manifest row says how the file went
+    started = datetime.now()
+    record_file(digest, path=path, size=os.path.getsize(path), status='loading', error=None,
+                started_at=started, finished_at=None)
+    try:
+        inserted, _, records = db.bulk_import_cars(path, chunk_size, on_conflict)
+    except Exception as e:
+        record_file(digest, status='failed', error=str(e)[:2000], finished_at=datetime.now())
+        return {'path': path, 'status': 'failed', 'error': str(e), 'records': 0, 'inserted': 0}
+    record_file(digest, status='done', records=records, inserted=inserted, finished_at=datetime.now())
+    return {'path': path, 'status': 'done', 'records': records, 'inserted': inserted,
+            'elapsed': (datetime.now() - started).total_seconds()}
+
+
+def backfill(sources, processes=workers, chunk_size=None, on_conflict='update', force=False, refresh=True):
+    started = datetime.now()
+    # once here, so the workers don't queue up on the migration's locks
+    db.migrate()
+    files = find_files(sources)
+    done = set() if force else loaded_digests()
+    todo = []
+    for path in files:
+        digest = file_digest(path)
+        if digest not in done:
+            todo.append((path, digest))
+    logger.info('%d files found, %d already loaded, loading %d on %d processes (%d connections)',
+                len(files), len(files) - len(todo), len(todo), processes, processes * worker_pool_size)
+
+    results = []
+    # spawn: every worker builds its own engine instead of inheriting the parent's sockets
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker) as pool:
+        futures = [pool.submit(load_file, path, digest, chunk_size, on_conflict) for path, digest in todo]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result['status'] == 'done':
+                logger.info('%s: %d records, %d new in %.1fs', os.path.basename(result['path']),
+                            result['records'], result['inserted'], result['elapsed'])
+            else:
+                logger.error('%s failed: %s', os.path.basename(result['path']), result['error'])
+
+    failed = [result for result in results if result['status'] == 'failed']
+    # once for the whole backfill rather than after every file
+    if refresh and len(results) > len(failed):
+        market_views.refresh_views(db.engine)
+
+    elapsed = (datetime.now() - started).total_seconds()
+    records = sum(result['records'] for result in results)
+    logger.info('Backfill done in %.0fs: %d files loaded, %d skipped, %d failed, %d records (%d new), %.0f rows/sec',
+                elapsed, len(results) - len(failed), len(files) - len(todo), len(failed), records,
+                sum(result['inserted'] for result in results), records / elapsed if elapsed else 0)
+    for result in failed:
+        logger.error('  %s: %s', result['path'], result['error'])
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load many scrape output files into cars_cm2 in parallel')
+    parser.add_argument('sources', nargs='+', help='files, globs or directories to search for car_list_* files')
+    parser.add_argument('--processes', type=int, default=workers)
+    parser.add_argument('--chunk-size', type=int, default=db.copy_chunk_size)
+    parser.add_argument('--on-conflict', choices=['update', 'nothing'], default='update')
+    parser.add_argument('--force', action='store_true', help='load files the manifest says are already loaded')
+    parser.add_argument('--no-refresh', action='store_true', help="don't refresh the dashboard views at the end")
+    args = parser.parse_args()
+
+    backfill(args.sources, args.processes, args.chunk_size, args.on_conflict, args.force, not args.no_refresh)
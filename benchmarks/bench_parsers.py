@@ -0,0 +1,89 @@
+"""Timings of the parsers over the recorded pages in fixtures/.
+
+    python benchmarks/bench_parsers.py [--number N] [--profile NAME]
+
+The html benchmarks need selectolax and are skipped without it.
+"""
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import parsers
+
+FIXTURES = os.path.join(ROOT, 'fixtures')
+TIMESTAMP = '2025-01-14 08:25:00'
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return json.load(f) if name.endswith('.json') else f.read()
+
+
+def benchmarks():
+    # name -> (callable, records per call)
+    fsale_cards = fixture('4sale_cards.json')
+    motorgy_cards = fixture('motorgy_cards.json')
+    next_data = fixture('4sale_next_data.json')
+
+    benches = {
+        '4sale_card': (lambda: [parsers.parse_4sale_card(card, 'toyota', 1, TIMESTAMP)
+                                for card in fsale_cards], len(fsale_cards)),
+        '4sale_listing': (lambda: [parsers.parse_4sale_listing(listing, 'toyota', 1, TIMESTAMP)
+                                   for listing in parsers.find_listings(next_data)],
+                          len(parsers.find_listings(next_data))),
+        'motorgy_card': (lambda: [parsers.parse_motorgy_card(card, 1, TIMESTAMP)
+                                  for card in motorgy_cards], len(motorgy_cards)),
+    }
+    if parsers.HTMLParser is not None:
+        fsale_html = fixture('4sale_listing.html')
+        motorgy_html = fixture('motorgy_listing.html')
+        motorgy_details = fixture('motorgy_details.html')
+        benches.update({
+            '4sale_page': (lambda: parsers.parse_4sale_page(fsale_html, 'toyota', 1, TIMESTAMP),
+                           len(parsers.extract_4sale_cards(fsale_html))),
+            'motorgy_page': (lambda: parsers.parse_motorgy_page(motorgy_html, 1, TIMESTAMP),
+                             len(parsers.extract_motorgy_cards(motorgy_html))),
+            'motorgy_last_page': (lambda: parsers.motorgy_last_page(motorgy_html), 1),
+            'motorgy_details': (lambda: parsers.parse_motorgy_details(motorgy_details), 1),
+        })
+    return benches
+
+
+def run(number, repeat):
+    benches = benchmarks()
+    if parsers.HTMLParser is None:
+        print('selectolax is not installed, skipping the html benchmarks')
+    print(f'{"benchmark":<20}{"us/call":>12}{"us/record":>12}')
+    for name, (func, records) in benches.items():
+        best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+        print(f'{name:<20}{best * 1e6:>12.1f}{best * 1e6 / max(records, 1):>12.2f}')
+
+
+def profile(name, number):
+    func, _ = benchmarks()[name]
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for _ in range(number):
+        func()
+    profiler.disable()
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the parsers over the recorded fixtures')
+    parser.add_argument('--number', type=int, default=100, help='calls per timing')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--profile', metavar='NAME', help='profile one benchmark instead of timing them all')
+    args = parser.parse_args()
+
+    if args.profile:
+        profile(args.profile, args.number)
+    else:
+        run(args.number, args.repeat)
@@ -0,0 +1,277 @@
+from playwright.async_api import async_playwright
+import argparse
+import asyncio
+import importlib
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+
+from scrape_sink import JsonlSink
+
+logger = logging.getLogger(__name__)
+
+# seconds a leased task stays with its worker without a heartbeat
+lease_seconds = 600
+heartbeat_seconds = 60
+# leases a task gets before it is marked failed
+max_attempts = 3
+# seconds a worker waits for new tasks when the queue is empty (with --wait)
+poll_seconds = 30
+headless = True
+
+POSTGRES_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS crawl_tasks (
+        id BIGSERIAL PRIMARY KEY,
+        site TEXT NOT NULL,
+        brand TEXT NOT NULL,
+        first_page INTEGER NOT NULL,
+        last_page INTEGER,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL,
+        worker TEXT,
+        lease_expires_at TIMESTAMP,
+        heartbeat_at TIMESTAMP,
+        records INTEGER,
+        output_file TEXT,
+        error TEXT,
+        created_at TIMESTAMP NOT NULL,
+        updated_at TIMESTAMP NOT NULL,
+        UNIQUE (site, brand, first_page)
+    )'''
+
+SQLITE_SCHEMA = POSTGRES_SCHEMA.replace('BIGSERIAL PRIMARY KEY', 'INTEGER PRIMARY KEY AUTOINCREMENT')
+
+# the oldest task nobody holds, or whose worker stopped sending heartbeats;
+# SKIP LOCKED lets every worker grab a different row without waiting on the others
+LEASE_QUERY = '''
+    UPDATE crawl_tasks SET status = 'leased', worker = :worker, attempts = attempts + 1,
+        lease_expires_at = :expires, heartbeat_at = :now, updated_at = :now
+    WHERE id = (
+        SELECT id FROM crawl_tasks
+        WHERE (status = 'pending' OR (status = 'leased' AND lease_expires_at < :now))
+          AND attempts < max_attempts
+        ORDER BY id LIMIT 1 {lock}
+    )
+    RETURNING id, site, brand, first_page, last_page, attempts'''
+
+# a lease that ran out on the last attempt has nobody left to retry it
+EXPIRE_QUERY = '''
+    UPDATE crawl_tasks SET status = 'failed', error = coalesce(error, 'lease expired on the last attempt'),
+        lease_expires_at = NULL, updated_at = :now
+    WHERE status = 'leased' AND lease_expires_at < :now AND attempts >= max_attempts'''
+
+
+def database_url(local_path=None):
+    # the Postgres database from .env, or a local SQLite file when there is none
+    load_dotenv(override=True)
+    if local_path or not os.getenv('DB_HOST'):
+        return f"sqlite:///{local_path or 'crawl_state.db'}"
+    return (f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@"
+            f"{os.getenv('DB_HOST')}:{os.getenv('DB_PORT', '5432')}/{os.getenv('DB_NAME')}")
+
+
+class CrawlQueue:
+    """(site, brand, page range) crawl tasks shared by any number of workers.
+
+    Workers lease a task, send heartbeats while they scrape it and mark it
+    done or failed. A task whose lease runs out without a heartbeat goes to
+    the next worker that asks, until it has used up max_attempts.
+    """
+
+    def __init__(self, url=None):
+        self.engine = create_engine(url or database_url())
+        self.is_sqlite = self.engine.dialect.name == 'sqlite'
+        with self.engine.begin() as connection:
+            connection.execute(text(SQLITE_SCHEMA if self.is_sqlite else POSTGRES_SCHEMA))
+        # SQLite has a single writer, the UPDATE alone is already atomic there
+        self.lease_query = text(LEASE_QUERY.format(lock='' if self.is_sqlite else 'FOR UPDATE SKIP LOCKED'))
+
+    def enqueue(self, site, brand, first_page=1, last_page=None, attempts=max_attempts):
+        # a range that is pending or leased is left as it is, a done or failed one is queued again
+        now = datetime.now()
+        with self.engine.begin() as connection:
+            result = connection.execute(text(
+                'INSERT INTO crawl_tasks (site, brand, first_page, last_page, max_attempts, created_at, updated_at) '
+                'VALUES (:site, :brand, :first_page, :last_page, :max_attempts, :now, :now) '
+                'ON CONFLICT (site, brand, first_page) DO UPDATE SET '
+                "status = 'pending', last_page = excluded.last_page, max_attempts = excluded.max_attempts, "
+                'attempts = 0, worker = NULL, lease_expires_at = NULL, heartbeat_at = NULL, records = NULL, '
+                'output_file = NULL, error = NULL, updated_at = excluded.updated_at '
+                "WHERE crawl_tasks.status IN ('done', 'failed')"),
+                {'site': site, 'brand': brand, 'first_page': first_page, 'last_page': last_page,
+                 'max_attempts': attempts, 'now': now})
+        return result.rowcount
+
+    def lease(self, worker, seconds=lease_seconds):
+        now = datetime.now()
+        with self.engine.begin() as connection:
+            connection.execute(text(EXPIRE_QUERY), {'now': now})
+            row = connection.execute(self.lease_query, {
+                'worker': worker, 'now': now, 'expires': now + timedelta(seconds=seconds)}).fetchone()
+        return dict(row._mapping) if row else None
+
+    def heartbeat(self, task_id, worker, seconds=lease_seconds):
+        # False when the task was taken over, the worker should stop working on it
+        now = datetime.now()
+        with self.engine.begin() as connection:
+            result = connection.execute(text(
+                "UPDATE crawl_tasks SET lease_expires_at = :expires, heartbeat_at = :now, updated_at = :now "
+                "WHERE id = :id AND worker = :worker AND status = 'leased'"),
+                {'id': task_id, 'worker': worker, 'now': now, 'expires': now + timedelta(seconds=seconds)})
+        return result.rowcount == 1
+
+    def complete(self, task_id, worker, records, output_file):
+        with self.engine.begin() as connection:
+            connection.execute(text(
+                "UPDATE crawl_tasks SET status = 'done', records = :records, output_file = :output_file, "
+                "error = NULL, lease_expires_at = NULL, updated_at = :now WHERE id = :id AND worker = :worker"),
+                {'id': task_id, 'worker': worker, 'records': records, 'output_file': output_file,
+                 'now': datetime.now()})
+
+    def fail(self, task_id, worker, error):
+        # back to pending for another worker, or failed once it has no attempts left
+        with self.engine.begin() as connection:
+            connection.execute(text(
+                "UPDATE crawl_tasks SET status = CASE WHEN attempts < max_attempts THEN 'pending' ELSE 'failed' END, "
+                "error = :error, lease_expires_at = NULL, updated_at = :now WHERE id = :id AND worker = :worker"),
+                {'id': task_id, 'worker': worker, 'error': str(error)[:2000], 'now': datetime.now()})
+
+    def summary(self):
+        with self.engine.connect() as connection:
+            rows = connection.execute(text(
+                'SELECT status, count(*), coalesce(sum(records), 0) FROM crawl_tasks GROUP BY status'))
+            return {status: {'tasks': tasks, 'records': records} for status, tasks, records in rows}
+
+    def close(self):
+        self.engine.dispose()
+
+
+def enqueue_site(queue, site, pages_per_task=None, last_page=None, brands=None):
+    # one task per brand, or per pages_per_task pages when the page count is known
+    if site == 'q84sale':
+        brands = brands or list(importlib.import_module('4sale').cars_dict)
+    else:
+        brands = ['all']
+    queued = 0
+    for brand in brands:
+        if pages_per_task and last_page:
+            for first_page in range(1, last_page + 1, pages_per_task):
+                queued += queue.enqueue(site, brand, first_page, min(first_page + pages_per_task - 1, last_page))
+        else:
+            queued += queue.enqueue(site, brand)
+    return queued
+
+
+def task_filename(task):
+    pages = f"{task['first_page']}-{task['last_page'] or 'end'}"
+    return f"car_list_{task['site']}_{task['brand']}_{pages}_{datetime.now().strftime('%Y%m%d')}.jsonl"
+
+
+async def run_task(browser, task, sink):
+    if task['site'] == 'q84sale':
+        fsale = importlib.import_module('4sale')
+        return await fsale.run(browser, url=fsale.cars_dict[task['brand']], brand=task['brand'], sink=sink,
+                               start_page=task['first_page'], stop_page=task['last_page'])
+    motorgy = importlib.import_module('motorgy')
+    return await motorgy.scrape_range(browser, sink, start_page=task['first_page'], stop_page=task['last_page'])
+
+
+async def keep_leased(queue, task, worker, job):
+    # cancels job once another worker may have the task, returns True then
+    while True:
+        await asyncio.sleep(heartbeat_seconds)
+        if not await asyncio.to_thread(queue.heartbeat, task['id'], worker):
+            logger.warning('Lost the lease on task %d, stopping it', task['id'])
+            job.cancel()
+            return True
+
+
+async def work(queue, worker=None, wait=False):
+    # leases tasks until the queue is empty (or forever with wait), returns how many were done
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+    done = 0
+    async with async_playwright() as playwright:
+        browser = await playwright.chromium.launch(headless=headless)
+        try:
+            while True:
+                task = await asyncio.to_thread(queue.lease, worker)
+                if task is None:
+                    if not wait:
+                        break
+                    await asyncio.sleep(poll_seconds)
+                    continue
+
+                logger.info('%s took task %d: %s %s pages %d-%s (attempt %d)', worker, task['id'], task['site'],
+                            task['brand'], task['first_page'], task['last_page'] or 'end', task['attempts'])
+                sink = JsonlSink(task_filename(task))
+                if task['first_page'] > 1 or task['last_page']:
+                    # one range of a site split over tasks doesn't show what was removed
+                    sink.mark_incomplete(f"pages {task['first_page']}-{task['last_page'] or 'end'} only")
+                job = asyncio.create_task(run_task(browser, task, sink))
+                heartbeat = asyncio.create_task(keep_leased(queue, task, worker, job))
+                try:
+                    await job
+                except asyncio.CancelledError:
+                    if not (heartbeat.done() and heartbeat.result()):
+                        raise
+                    # the task is someone else's now, its pages stay in the .part file
+                    sink.close(finished=False)
+                except Exception as e:
+                    logger.error('Task %d failed: %s', task['id'], e, exc_info=True)
+                    sink.close(finished=False)
+                    await asyncio.to_thread(queue.fail, task['id'], worker, repr(e))
+                else:
+                    sink.close()
+                    await asyncio.to_thread(queue.complete, task['id'], worker, sink.records_written, sink.filename)
+                    done += 1
+                finally:
+                    heartbeat.cancel()
+        finally:
+            await browser.close()
+    logger.info('%s finished %d tasks', worker, done)
+    return done
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('crawl_queue_log.log'),
+            logging.StreamHandler()
+        ]
+    )
+
+    parser = argparse.ArgumentParser(description='Crawl tasks shared by workers on any number of machines')
+    parser.add_argument('--sqlite', metavar='PATH', help='use a local SQLite queue instead of the Postgres database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    enqueue = subparsers.add_parser('enqueue', help='queue the crawl of a site')
+    enqueue.add_argument('site', choices=['q84sale', 'motorgy'])
+    enqueue.add_argument('--brand', action='append', help='4sale brands to queue, every brand by default')
+    enqueue.add_argument('--last-page', type=int, help='known page count, needed to split into page ranges')
+    enqueue.add_argument('--pages-per-task', type=int)
+
+    worker = subparsers.add_parser('work', help='lease and scrape tasks')
+    worker.add_argument('--wait', action='store_true', help='keep polling once the queue is empty')
+    worker.add_argument('--name', help='worker name, hostname:pid by default')
+
+    subparsers.add_parser('status', help='tasks and records per status')
+
+    args = parser.parse_args()
+    queue = CrawlQueue(database_url(args.sqlite))
+    try:
+        if args.command == 'enqueue':
+            logger.info('%d tasks queued', enqueue_site(queue, args.site, args.pages_per_task, args.last_page, args.brand))
+        elif args.command == 'work':
+            asyncio.run(work(queue, args.name, args.wait))
+        else:
+            for status, counts in queue.summary().items():
+                print(f"{status:<10}{counts['tasks']:>8} tasks{counts['records']:>10} records")
+    finally:
+        queue.close()
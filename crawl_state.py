@@ -0,0 +1,163 @@
+import sqlite3
+from datetime import datetime
+
+from scrape_sink import JsonlSink
+
+
+class SeenIndex:
+    """Listings already scraped, per site and brand, kept in a small SQLite file."""
+
+    def __init__(self, path='crawl_state.db'):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS seen_listings (
+                site TEXT NOT NULL,
+                brand TEXT NOT NULL,
+                listing_key TEXT NOT NULL,
+                first_seen TEXT NOT NULL,
+                last_seen TEXT NOT NULL,
+                PRIMARY KEY (site, brand, listing_key)
+            )''')
+        self.conn.commit()
+
+    @staticmethod
+    def listing_key(record):
+        # the listing url carries the site's ad id, it is stable across runs
+        return record.get('url')
+
+    def known(self, site, brand, records):
+        keys = [self.listing_key(record) for record in records if self.listing_key(record)]
+        known = set()
+        # stay under SQLite's limit on bound parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.conn.execute(
+                'SELECT listing_key FROM seen_listings WHERE site = ? AND brand = ? '
+                f'AND listing_key IN ({",".join("?" * len(chunk))})',
+                [site, brand, *chunk])
+            known.update(row[0] for row in rows)
+        return known
+
+    def add(self, site, brand, records):
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.conn.executemany(
+            'INSERT INTO seen_listings (site, brand, listing_key, first_seen, last_seen) '
+            'VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (site, brand, listing_key) DO UPDATE SET last_seen = excluded.last_seen',
+            [(site, brand, key, now, now)
+             for key in (self.listing_key(record) for record in records) if key])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class IncrementalCrawl:
+    """Filters one site/brand crawl down to new listings and says when to stop.
+
+    Pagination stops after stop_after_pages pages in a row that only had
+    listings already in the index.
+    """
+
+    def __init__(self, index, site, brand, stop_after_pages=1):
+        self.index = index
+        self.site = site
+        self.brand = brand
+        self.stop_after_pages = stop_after_pages
+        self.known_pages = 0
+
+    def new_records(self, records):
+        known = self.index.known(self.site, self.brand, records)
+        new = [record for record in records if SeenIndex.listing_key(record) not in known]
+        if records and not new:
+            self.known_pages += 1
+        else:
+            self.known_pages = 0
+        return new
+
+    def mark_seen(self, records):
+        # called once the page is written so a crash never hides a listing
+        self.index.add(self.site, self.brand, records)
+
+    @property
+    def should_stop(self):
+        return self.known_pages >= self.stop_after_pages
+
+
+class Checkpoint:
+    """Progress of each site/brand crawl, saved after every written page.
+
+    A run that crashed leaves its row 'running', the next run picks it up
+    from the page after last_page and appends to the same output file.
+    """
+
+    def __init__(self, path='crawl_state.db'):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS crawl_checkpoints (
+                site TEXT NOT NULL,
+                brand TEXT NOT NULL,
+                status TEXT NOT NULL,
+                last_page INTEGER NOT NULL,
+                records_flushed INTEGER NOT NULL,
+                bytes_flushed INTEGER NOT NULL,
+                output_file TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (site, brand)
+            )''')
+        self.conn.commit()
+
+    def load(self, site, brand):
+        # returns the unfinished crawl for site/brand, or None
+        row = self.conn.execute(
+            'SELECT last_page, records_flushed, bytes_flushed, output_file FROM crawl_checkpoints '
+            "WHERE site = ? AND brand = ? AND status = 'running'", (site, brand)).fetchone()
+        if row is None:
+            return None
+        return {
+            'last_page': row[0],
+            'records_flushed': row[1],
+            'bytes_flushed': row[2],
+            'output_file': row[3],
+        }
+
+    def save(self, site, brand, last_page, sink):
+        self.conn.execute(
+            'INSERT INTO crawl_checkpoints (site, brand, status, last_page, records_flushed, '
+            "bytes_flushed, output_file, updated_at) VALUES (?, ?, 'running', ?, ?, ?, ?, ?) "
+            'ON CONFLICT (site, brand) DO UPDATE SET status = excluded.status, '
+            'last_page = excluded.last_page, records_flushed = excluded.records_flushed, '
+            'bytes_flushed = excluded.bytes_flushed, output_file = excluded.output_file, '
+            'updated_at = excluded.updated_at',
+            (site, brand, last_page, sink.records_written, sink.bytes_written, sink.filename,
+             datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        self.conn.commit()
+
+    def finish(self, site, brand):
+        self.conn.execute(
+            "UPDATE crawl_checkpoints SET status = 'done', updated_at = ? WHERE site = ? AND brand = ?",
+            (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), site, brand))
+        self.conn.commit()
+
+    def open_sink(self, site, brand, filename, compression=None):
+        # resumes the output file of an unfinished crawl, or starts filename
+        state = self.load(site, brand)
+        if state is None:
+            return JsonlSink(filename, compression=compression), 1
+        return JsonlSink(state['output_file'], compression=compression,
+                         resume_bytes=state['bytes_flushed'],
+                         resume_records=state['records_flushed']), state['last_page'] + 1
+
+    def close(self):
+        self.conn.close()
+
+
+def write_new_page(sink, records, crawl=None):
+    # in incremental mode only the listings not seen before are written
+    new_records = crawl.new_records(records) if crawl else records
+    sink.write_page(new_records)
+    if crawl:
+        crawl.mark_seen(records)
+    return len(new_records)
@@ -1,7 +1,28 @@
+import os
 import pandas as pd
 from scipy import stats
 
-def process_data(file='cars_202501140825.csv'):
+def load_market_views():
+    # the same result as the csv mode, aggregated in Postgres by the views in market_views.py
+    from dotenv import load_dotenv
+    from sqlalchemy import create_engine, text
+
+    load_dotenv(override=True)
+    engine = create_engine(f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@"
+                           f"{os.getenv('DB_HOST')}:{os.getenv('DB_PORT', '5432')}/{os.getenv('DB_NAME')}")
+    with engine.connect() as connection:
+        total_cars = connection.execute(text('SELECT total_cars FROM market_summary')).scalar()
+        df_reshaped = pd.read_sql(
+            'SELECT brand, model, color, year, car_origin, median_mileage, median_price, count, '
+            'mileage_zscore, price_zscore FROM market_groups ORDER BY brand, model, color, year', connection)
+    engine.dispose()
+    return total_cars, df_reshaped
+
+def process_data(file='cars_202501140825.csv', mode=None):
+    # mode 'views' reads the pre-aggregated rows from the database instead of the csv dump
+    if (mode or os.getenv('DASHBOARD_DATA', 'csv')) == 'views':
+        return load_market_views()
+
     df = pd.read_csv(file)
 
     # Define car origins
@@ -0,0 +1,190 @@
+from playwright.async_api import async_playwright
+import argparse
+import asyncio
+import importlib
+import logging
+import os
+import random
+from datetime import datetime
+from urllib.parse import urljoin, urlparse
+
+import safe_scrape as ss
+from scrape_sink import JsonlSink, iter_records
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('detail_scrape_log.log'),
+        logging.StreamHandler()
+    ]
+)
+
+logger = logging.getLogger(__name__)
+
+user_agents = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Edge/120.0.0.0',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+]
+
+user_agent = random.choice(user_agents)
+
+# number of long lived pages working through the queue
+workers = 4
+# seconds one listing may take (navigation + extraction) before it is retried
+task_timeout = 90
+retries = 2
+headless = False
+# skip images, fonts, media and trackers, see safe_scrape.ResourcePolicy
+block_resources = True
+
+# list scrapes store relative links, the path tells which site they belong to
+SITES = {
+    '/en/listing/': ('q84sale', 'https://www.q84sale.com'),
+    '/en/car-details/': ('motorgy', 'https://www.motorgy.com'),
+}
+
+# the per site extract_details(page) live in the existing detail scripts
+EXTRACTORS = {
+    'q84sale': importlib.import_module('4sale_internal').extract_details,
+    'motorgy': importlib.import_module('motorgy_internal').extract_details,
+}
+
+
+def listing_site(url):
+    # returns (site, absolute url), or (None, url) for links we have no extractor for
+    path = urlparse(url).path
+    for prefix, (site, base) in SITES.items():
+        if path.startswith(prefix):
+            return site, urljoin(base, url)
+    return None, url
+
+
+def urls_from_files(filenames):
+    for filename in filenames:
+        for record in iter_records(filename):
+            if record.get('url'):
+                yield record['url']
+
+
+def urls_from_db(limit=None):
+    # listing urls already imported into cars_cm2, newest first
+    from dotenv import load_dotenv
+    from sqlalchemy import create_engine, text
+
+    load_dotenv(override=True)
+    engine = create_engine(f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@"
+                           f"{os.getenv('DB_HOST')}:{os.getenv('DB_PORT', '5432')}/{os.getenv('DB_NAME')}")
+    query = 'SELECT url FROM cars_cm2 WHERE url IS NOT NULL GROUP BY url ORDER BY max(timestamp) DESC'
+    if limit:
+        query += ' LIMIT :limit'
+    with engine.connect() as connection:
+        for row in connection.execute(text(query), {'limit': limit}):
+            yield row[0]
+    engine.dispose()
+
+
+async def scrape_detail(page, site, url):
+    await ss.goto(page, url)
+    details = await EXTRACTORS[site](page)
+    return {
+        'url': url,
+        'site': site,
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'details': details,
+    }
+
+
+async def worker(context, queue, sink, stats):
+    # every task is queued before the workers start, a worker stops when the queue is empty
+    page = None
+    while not queue.empty():
+        task = queue.get_nowait()
+        site, url = task
+        for attempt in range(retries + 1):
+            if page is None:
+                try:
+                    page = await context.new_page()
+                except Exception as e:
+                    # without pages this worker can't scrape anything, the others take its task
+                    logger.error('Could not open a page, stopping the worker: %s', e)
+                    queue.put_nowait(task)
+                    return
+            try:
+                record = await asyncio.wait_for(scrape_detail(page, site, url), task_timeout)
+            except Exception as e:
+                logger.warning('Attempt %d for %s failed: %s', attempt + 1, url, e)
+                # a page that timed out mid navigation is not worth reusing, the next attempt opens a new one
+                try:
+                    await page.close()
+                except Exception as close_error:
+                    logger.warning('Could not close the page after %s: %s', url, close_error)
+                page = None
+                if attempt == retries:
+                    stats['failed'] += 1
+                    logger.error('Giving up on %s', url)
+                else:
+                    await asyncio.sleep(ss.backoff_delay(attempt, ss.classify_error(e)))
+                continue
+
+            sink.write_page([record])
+            stats['done'] += 1
+            if stats['done'] % 50 == 0:
+                logger.info('%d listings scraped, %d failed, %d queued', stats['done'], stats['failed'], queue.qsize())
+            break
+    if page is not None:
+        await page.close()
+
+
+async def run(urls, output='car_details.jsonl', concurrency=workers):
+    queue = asyncio.Queue()
+    seen = set()
+    for url in urls:
+        site, url = listing_site(url)
+        if site is None:
+            logger.warning('No detail extractor for %s, skipping', url)
+        elif url not in seen:
+            seen.add(url)
+            queue.put_nowait((site, url))
+    logger.info('%d listings queued for %d workers', len(seen), concurrency)
+
+    stats = {'done': 0, 'failed': 0}
+    started = datetime.now()
+    with JsonlSink(output) as sink:
+        async with async_playwright() as playwright:
+            browser = await playwright.chromium.launch(headless=headless)
+            context = await browser.new_context(viewport={"width": 1600, "height": 900},
+                                                user_agent=user_agent,
+                                                locale='en-US',
+                                                timezone_id='America/New_York')
+            policy = await ss.apply_resource_policy(context) if block_resources else None
+            try:
+                await asyncio.gather(*(worker(context, queue, sink, stats) for _ in range(concurrency)))
+            finally:
+                await browser.close()
+                if policy:
+                    logger.info('Resource policy: %s', policy.report())
+
+    stats['unscraped'] = queue.qsize()
+    if stats['unscraped']:
+        logger.error('%d listings were left unscraped, every worker stopped', stats['unscraped'])
+    elapsed = (datetime.now() - started).total_seconds()
+    logger.info('Detail scrape done: %d listings, %d failed in %.0fs (%.0f/hour), written to %s',
+                stats['done'], stats['failed'], elapsed, stats['done'] / elapsed * 3600 if elapsed else 0,
+                sink.filename)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Scrape listing detail pages with a pool of browser pages')
+    parser.add_argument('files', nargs='*', help='list scrape output files (.jsonl, .json) to take urls from')
+    parser.add_argument('--from-db', action='store_true', help='take the urls from cars_cm2 instead')
+    parser.add_argument('--limit', type=int, help='max number of urls read from the database')
+    parser.add_argument('--workers', type=int, default=workers)
+    parser.add_argument('--output', default='car_details.jsonl')
+    args = parser.parse_args()
+
+    urls = urls_from_db(args.limit) if args.from_db else urls_from_files(args.files)
+    asyncio.run(run(urls, output=args.output, concurrency=args.workers))
@@ -0,0 +1,162 @@
+import argparse
+import gzip
+import hashlib
+import logging
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import parsers
+from scrape_sink import JsonlSink
+
+try:
+    import zstandard
+except ImportError:  # falls back to gzip objects
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+archive_root = 'html_archive'
+
+
+class HtmlArchive:
+    """Raw listing page html, stored once per content hash and indexed in SQLite.
+
+    Objects live in <root>/objects/<2 hex>/<sha256>.html.zst (.gz without
+    zstandard), index.db maps every fetch (site, brand, page, url, time) to
+    the hash, so the same html fetched twice costs one object.
+    """
+
+    def __init__(self, root=archive_root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(root, 'index.db'), timeout=30)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                sha256 TEXT NOT NULL,
+                site TEXT NOT NULL,
+                brand TEXT,
+                page INTEGER,
+                url TEXT,
+                fetched_at TEXT NOT NULL
+            )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS pages_site_brand_page ON pages (site, brand, page)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS pages_fetched_at ON pages (fetched_at)')
+        self.conn.commit()
+
+    def object_path(self, digest):
+        suffix = '.html.zst' if zstandard is not None else '.html.gz'
+        return os.path.join(self.root, 'objects', digest[:2], digest + suffix)
+
+    def store(self, html, site, brand, page, url, fetched_at=None):
+        data = html.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            compressed = zstandard.ZstdCompressor(level=10).compress(data) if zstandard else gzip.compress(data)
+            # write then rename so a crash never leaves half an object under its hash
+            with open(path + '.tmp', 'wb') as f:
+                f.write(compressed)
+            os.replace(path + '.tmp', path)
+
+        self.conn.execute(
+            'INSERT INTO pages (sha256, site, brand, page, url, fetched_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (digest, site, brand, page, url, fetched_at or datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        self.conn.commit()
+        return digest
+
+    def pages(self, site=None, brand=None, since=None, until=None):
+        # index rows as dicts, oldest fetch first
+        query = 'SELECT sha256, site, brand, page, url, fetched_at FROM pages WHERE 1 = 1'
+        params = []
+        for column, op, value in (('site', '=', site), ('brand', '=', brand),
+                                  ('fetched_at', '>=', since), ('fetched_at', '<', until)):
+            if value is not None:
+                query += f' AND {column} {op} ?'
+                params.append(value)
+        query += ' ORDER BY fetched_at, site, brand, page'
+        columns = ('sha256', 'site', 'brand', 'page', 'url', 'fetched_at')
+        return [dict(zip(columns, row)) for row in self.conn.execute(query, params)]
+
+    def close(self):
+        self.conn.close()
+
+
+def load_html(root, digest):
+    for suffix in ('.html.zst', '.html.gz'):
+        path = os.path.join(root, 'objects', digest[:2], digest + suffix)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            if suffix == '.html.gz':
+                return gzip.decompress(data).decode('utf-8')
+            return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    raise FileNotFoundError(f'No archived html for {digest}')
+
+
+_default_archive = None
+
+
+def default_archive():
+    # one archive per process, opened the first time a scraper stores a page
+    global _default_archive
+    if _default_archive is None:
+        _default_archive = HtmlArchive()
+    return _default_archive
+
+
+def parse_archived_page(root, row):
+    # runs in a worker process: html from the archive through the site's current extractor
+    html = load_html(root, row['sha256'])
+    # the record describes the listing as it was when the page was fetched
+    if row['site'] == 'motorgy':
+        return parsers.parse_motorgy_page(html, row['page'], row['fetched_at'])
+    return parsers.parse_4sale_page(html, row['brand'], row['page'], row['fetched_at'])
+
+
+def reparse(output, root=archive_root, workers=None, **filters):
+    archive = HtmlArchive(root)
+    rows = archive.pages(**filters)
+    archive.close()
+    logger.info('Re-parsing %d archived pages on %d processes', len(rows), workers or os.cpu_count())
+
+    started = datetime.now()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool, JsonlSink(output) as sink:
+        futures = [pool.submit(parse_archived_page, root, row) for row in rows]
+        for row, future in zip(rows, futures):
+            try:
+                sink.write_page(future.result())
+            except Exception as e:
+                failed += 1
+                logger.error('Could not re-parse %s (%s page %s): %s', row['sha256'], row['site'], row['page'], e)
+
+    elapsed = (datetime.now() - started).total_seconds()
+    logger.info('Re-parsed %d pages into %d records in %.1fs (%d failed), written to %s',
+                len(rows) - failed, sink.records_written, elapsed, failed, sink.filename)
+    return sink.records_written
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler()
+        ]
+    )
+
+    parser = argparse.ArgumentParser(description='Replay archived listing html through the current extractors')
+    parser.add_argument('output', help='JSON Lines file for the re-parsed records')
+    parser.add_argument('--root', default=archive_root)
+    parser.add_argument('--site', choices=['q84sale', 'motorgy'])
+    parser.add_argument('--brand')
+    parser.add_argument('--since', help="fetched at or after, e.g. '2025-01-01'")
+    parser.add_argument('--until', help='fetched before')
+    parser.add_argument('--workers', type=int, help='processes, defaults to every core')
+    args = parser.parse_args()
+
+    reparse(args.output, root=args.root, workers=args.workers,
+            site=args.site, brand=args.brand, since=args.since, until=args.until)
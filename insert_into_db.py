@@ -1,10 +1,21 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime
-from sqlalchemy.dialects.postgresql import UUID  # If using PostgreSQL
+from sqlalchemy import (create_engine, Column, BigInteger, Integer, SmallInteger, String, Float, Date, DateTime, Text,
+                        Computed, ForeignKey, Index, UniqueConstraint, column, false, literal_column, select, table,
+                        text, tuple_)
+from sqlalchemy.dialects.postgresql import UUID, insert  # If using PostgreSQL
 import uuid
 #from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, declarative_base
-import json
+from scrape_sink import iter_batches, read_run_info
+from normalize import normalize_mileage, normalize_name, normalize_year, to_records
+from parsers import url_site
+import market_views
+import partitions
+import pandas as pd
 from datetime import datetime
+import argparse
+import csv
+from collections import Counter
+import io
 import os
 from dotenv import load_dotenv
 import logging
@@ -32,79 +43,618 @@ db_host = os.getenv('DB_HOST')
 db_port = os.getenv('DB_PORT', '5432')
 db_name = os.getenv('DB_NAME')
 
-# Define the Car model
+# Lookup tables, cars_cm2 refers to them by id
+class Source(Base):
+    __tablename__ = 'sources'
+
+    id = Column(SmallInteger, primary_key=True)
+    name = Column(String(20), unique=True, nullable=False)  # q84sale, motorgy
+
+class Brand(Base):
+    __tablename__ = 'brands'
+
+    id = Column(SmallInteger, primary_key=True)
+    name = Column(String(50), unique=True, nullable=False)
+
+class CarModel(Base):
+    __tablename__ = 'models'
+    __table_args__ = (UniqueConstraint('brand_id', 'name'),)
+
+    id = Column(Integer, primary_key=True)
+    brand_id = Column(SmallInteger, ForeignKey('brands.id'), nullable=False)
+    name = Column(String(50), nullable=False)
+
+class Color(Base):
+    __tablename__ = 'colors'
+
+    id = Column(SmallInteger, primary_key=True)
+    name = Column(String(50), unique=True, nullable=False)
+
+# what a scrape says about a listing (UPSERT_COLUMNS without page and the ids);
+# a listing whose hash is unchanged gets no listing_changes row
+CONTENT_HASH = ("md5(coalesce(url, '') || '|' || coalesce(model, '') || '|' || "
+                "coalesce(year::text, '') || '|' || coalesce(mileage::text, '') || '|' || coalesce(mileage_raw, '') "
+                "|| '|' || coalesce(color, '') || '|' || coalesce(price::text, ''))")
+
+# Define the Car model, the current state of every listing
 class Car(Base):
     __tablename__ = 'cars_cm2'
-    
+    # the dashboard filters and groups on brand/model/year, the loaders on scrape time
+    __table_args__ = (
+        Index('cars_cm2_brand_model_year', 'brand', 'model', 'year'),
+        Index('cars_cm2_timestamp', 'timestamp'),
+    )
+
+    # parsers.listing_uuid: the same listing has the same uuid on every scrape
     uuid = Column(String(36), unique=True, primary_key=True, default=lambda: str(uuid.uuid4())) 
     url = Column(String(100))
     brand = Column(String(50))
     page = Column(Integer)
     timestamp = Column(DateTime)
     model = Column(String(50))
-    year = Column(String(4))
-    mileage = Column(String(30)) #a lot of junk data here, ideally it should be int but because of junk data we need string
+    year = Column(SmallInteger)
+    mileage = Column(Integer)
+    mileage_raw = Column(String(30))  # the scraped text when normalize.py can't read it as km
     color = Column(String(50))
     price = Column(Float)
+    last_seen = Column(DateTime)
+    source_id = Column(SmallInteger, ForeignKey('sources.id'))
+    brand_id = Column(SmallInteger, ForeignKey('brands.id'))
+    model_id = Column(Integer, ForeignKey('models.id'))
+    color_id = Column(SmallInteger, ForeignKey('colors.id'))
+    content_hash = Column(String(32), Computed(CONTENT_HASH, persisted=True))
+    removed_at = Column(DateTime)  # set when a full run of its brand no longer finds it
+
+# SCD-2 history of cars_cm2: one row per version of a listing, written only when it
+# appears, changes, disappears or comes back; valid_to is NULL on the current version
+class ListingChange(Base):
+    __tablename__ = 'listing_changes'
+    __table_args__ = (
+        Index('listing_changes_uuid_valid_from', 'uuid', 'valid_from'),
+        Index('listing_changes_current', 'uuid', postgresql_where=text('valid_to IS NULL')),
+    )
+
+    id = Column(BigInteger, primary_key=True)
+    uuid = Column(String(36), nullable=False)
+    change = Column(String(10), nullable=False)  # baseline, new, changed, removed, returned
+    content_hash = Column(String(32))
+    brand_id = Column(SmallInteger)
+    model_id = Column(Integer)
+    year = Column(SmallInteger)
+    mileage = Column(Integer)
+    mileage_raw = Column(String(30))
+    color_id = Column(SmallInteger)
+    price = Column(Float)
+    valid_from = Column(DateTime, nullable=False)
+    valid_to = Column(DateTime)
+
+# Every scrape of every listing, cars_cm2 only keeps the latest; range partitioned by
+# scrape time, partitions.py adds partitions on ingest and rolls old ones into daily_market
+class CarScrape(Base):
+    __tablename__ = 'car_scrapes'
+    __table_args__ = (
+        Index('car_scrapes_brand_model_year', 'brand_id', 'model_id', 'year'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+
+    uuid = Column(String(36), primary_key=True)
+    timestamp = Column(DateTime, primary_key=True)
+    page = Column(Integer)
+    source_id = Column(SmallInteger)
+    brand_id = Column(SmallInteger)
+    model_id = Column(Integer)
+    year = Column(SmallInteger)
+    mileage = Column(Integer)
+    color_id = Column(SmallInteger)
+    price = Column(Float)
+
+# car_scrapes partitions past the retention window, one row per day/brand/model/year (0 when unknown)
+class DailyMarket(Base):
+    __tablename__ = 'daily_market'
+
+    day = Column(Date, primary_key=True)
+    brand_id = Column(SmallInteger, primary_key=True)
+    model_id = Column(Integer, primary_key=True)
+    year = Column(SmallInteger, primary_key=True)
+    listings = Column(Integer)
+    scrapes = Column(Integer)
+    median_price = Column(Float)
+    median_mileage = Column(Float)
+    min_price = Column(Float)
+    max_price = Column(Float)
+
+# Files loaded by backfill.py, keyed by content so a rewritten file is loaded again
+class IngestManifest(Base):
+    __tablename__ = 'ingest_manifest'
+
+    sha256 = Column(String(64), primary_key=True)
+    path = Column(Text)
+    size = Column(BigInteger)
+    status = Column(String(10))  # loading, done, failed
+    records = Column(Integer)
+    inserted = Column(Integer)
+    error = Column(Text)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+# connections kept open per process, and how many more it may open under load
+pool_size = int(os.getenv('DB_POOL_SIZE', '5'))
+max_overflow = int(os.getenv('DB_MAX_OVERFLOW', '5'))
+
+def make_engine(pool_size=pool_size, max_overflow=max_overflow):
+    # pre_ping replaces connections the server dropped while they sat in the pool
+    return create_engine(f"postgresql://{db_user}:{db_password}@" \
+                         f"{db_host}:{db_port}/{db_name}",
+                         pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=True)
 
 # Create database connection
-engine = create_engine(f"postgresql://{db_user}:{db_password}@" \
-                      f"{db_host}:{db_port}/{db_name}")
+engine = make_engine()
 # For SQLite you can use: engine = create_engine('sqlite:///cars.db')
 
-# Create tables if they don't exist
-Base.metadata.create_all(engine)
+# cars_cm2 as it was created before the typed schema: year and mileage were strings
+# because of the junk in them and there were no lookup ids or indexes
+NEW_COLUMNS = '''
+    ALTER TABLE cars_cm2
+        ADD COLUMN IF NOT EXISTS last_seen TIMESTAMP,
+        ADD COLUMN IF NOT EXISTS mileage_raw VARCHAR(30),
+        ADD COLUMN IF NOT EXISTS source_id SMALLINT REFERENCES sources (id),
+        ADD COLUMN IF NOT EXISTS brand_id SMALLINT REFERENCES brands (id),
+        ADD COLUMN IF NOT EXISTS model_id INTEGER REFERENCES models (id),
+        ADD COLUMN IF NOT EXISTS color_id SMALLINT REFERENCES colors (id)'''
+
+# normalize.normalize_name in SQL, so the names already in cars_cm2 get the ids new loads look up
+NAME_KEY = r"nullif(lower(trim(regexp_replace({}, '\s+', ' ', 'g'))), '')"
+
+TYPED_MIGRATION = [
+    # text that isn't a plain number stays readable in mileage_raw, reclean_mileage can retry it
+    r'''UPDATE cars_cm2 SET mileage_raw = left(mileage, 30)
+        WHERE mileage IS NOT NULL AND mileage !~ '^\s*\d{1,9}(\.\d+)?\s*$' ''',
+    r'''ALTER TABLE cars_cm2
+        ALTER COLUMN year TYPE SMALLINT USING CASE WHEN year ~ '^\s*\d{4}\s*$' THEN trim(year)::smallint END,
+        ALTER COLUMN mileage TYPE INTEGER USING
+            CASE WHEN mileage ~ '^\s*\d{1,9}(\.\d+)?\s*$' THEN round(trim(mileage)::numeric)::integer END''',
+    "INSERT INTO sources (name) VALUES ('q84sale'), ('motorgy') ON CONFLICT DO NOTHING",
+    f'''INSERT INTO brands (name) SELECT DISTINCT {NAME_KEY.format('brand')} FROM cars_cm2
+        WHERE {NAME_KEY.format('brand')} IS NOT NULL ON CONFLICT DO NOTHING''',
+    f'''INSERT INTO colors (name) SELECT DISTINCT {NAME_KEY.format('color')} FROM cars_cm2
+        WHERE {NAME_KEY.format('color')} IS NOT NULL ON CONFLICT DO NOTHING''',
+    f'''INSERT INTO models (brand_id, name)
+        SELECT DISTINCT b.id, {NAME_KEY.format('c.model')} FROM cars_cm2 c
+        JOIN brands b ON b.name = {NAME_KEY.format('c.brand')}
+        WHERE {NAME_KEY.format('c.model')} IS NOT NULL ON CONFLICT DO NOTHING''',
+    # one UPDATE so the table is rewritten once
+    f'''UPDATE cars_cm2 c SET
+        brand_id = (SELECT id FROM brands WHERE name = {NAME_KEY.format('c.brand')}),
+        model_id = (SELECT m.id FROM models m JOIN brands b ON b.id = m.brand_id
+                    WHERE b.name = {NAME_KEY.format('c.brand')} AND m.name = {NAME_KEY.format('c.model')}),
+        color_id = (SELECT id FROM colors WHERE name = {NAME_KEY.format('c.color')}),
+        source_id = (SELECT id FROM sources WHERE name = CASE
+            WHEN c.url LIKE '/en/listing/%' THEN 'q84sale'
+            WHEN c.url LIKE '/en/car-details/%' THEN 'motorgy' END)''',
+]
+
+# added after the typed migration, a generated column blocks changing the types it reads
+CDC_COLUMNS = f'''
+    ALTER TABLE cars_cm2
+        ADD COLUMN IF NOT EXISTS removed_at TIMESTAMP,
+        ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32) GENERATED ALWAYS AS ({CONTENT_HASH}) STORED'''
+
+VERSION_COLUMNS = 'content_hash, brand_id, model_id, year, mileage, mileage_raw, color_id, price'
+
+# listings loaded before listing_changes existed start with their current state as one version
+BASELINE_QUERY = f'''
+    INSERT INTO listing_changes (uuid, change, {VERSION_COLUMNS}, valid_from)
+    SELECT uuid, 'baseline', {VERSION_COLUMNS}, coalesce(last_seen, timestamp, now()) FROM cars_cm2
+    WHERE NOT EXISTS (SELECT 1 FROM listing_changes)'''
+
+def migrate_typed_schema(connection):
+    # a no-op once cars_cm2 has the typed columns, so it runs on every import
+    connection.execute(text(NEW_COLUMNS))
+    year_type = connection.execute(text(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_name = 'cars_cm2' AND column_name = 'year'")).scalar()
+    if year_type != 'smallint':
+        logger.info('Migrating cars_cm2 to numeric year/mileage and lookup ids, this rewrites the table')
+        for statement in TYPED_MIGRATION:
+            connection.execute(text(statement))
+    connection.execute(text(CDC_COLUMNS))
+    connection.execute(text(BASELINE_QUERY))
+    # create_all doesn't add indexes to a table that already exists
+    for index in Car.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+def migrate():
+    # creates the tables, brings cars_cm2 up to date and creates the dashboard views;
+    # run once before loading, never on import: the migration locks cars_cm2
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        migrate_typed_schema(connection)
+        # the dashboard aggregates, refreshed after every load
+        market_views.create_views(connection)
 
 # Create session factory
 Session = sessionmaker(bind=engine)
 session = Session()
 
-# Read JSON file
-def import_cars_from_json(filename):
-    with open(filename, 'r') as f:
-        cars_data = json.load(f)
-
-    # If the JSON contains a single object
-    if isinstance(cars_data, dict):
-        cars_data = [cars_data]
-
-    # Keep track of successfully imported cars
-    imported_count = 0
-
-    for car_data in cars_data:
-        for car in car_data:
-            try:
-                # Check if car with this UUID already exists
-                existing_car = session.query(Car).filter_by(uuid=car.get('uuid')).first()
-                
-                if existing_car:
-                    print(f"Car with UUID {car.get('uuid')} already exists, skipping")
-                    continue
-                
-                # If no UUID provided, generate one
-                if 'uuid' not in car:
-                    car['uuid'] = str(uuid.uuid4())
-                
-                # Create Car instance
-                new_car = Car(**car)
-                session.add(new_car)
-                imported_count += 1
-                
-            except Exception as e:
-                print(f"Error processing car: {e}")
-                continue
+def use_engine(pool_size, max_overflow=0):
+    # worker processes swap in a pool sized for one file at a time
+    global engine, Session, session
+    engine.dispose()
+    engine = make_engine(pool_size, max_overflow)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    return engine
+
+CAR_COLUMNS = ('uuid', 'url', 'brand', 'page', 'timestamp', 'model', 'year', 'mileage', 'color', 'price')
+# every column the loaders write, the scraped ones plus what ingest derives from them
+ROW_COLUMNS = CAR_COLUMNS + ('last_seen', 'mileage_raw', 'source_id', 'brand_id', 'model_id', 'color_id')
+# what a later scrape of a listing already in the table refreshes, timestamp stays the first scrape
+UPSERT_COLUMNS = ('url', 'page', 'model', 'model_id', 'year', 'mileage', 'mileage_raw', 'color', 'color_id', 'price',
+                  'last_seen')
+SCRAPE_COLUMNS = ('uuid', 'timestamp', 'page', 'source_id', 'brand_id', 'model_id', 'year', 'mileage', 'color_id', 'price')
+batch_size = 1000
+
+def lookup_ids(connection, table, keys, columns=('name',)):
+    # {key: id} for every key, keys seen for the first time are added to the table
+    # sorted, so parallel loaders adding the same names lock them in the same order
+    keys = sorted({key for key in keys if all(value is not None for value in key)})
+    if not keys:
+        return {}
+    connection.execute(insert(table).values([dict(zip(columns, key)) for key in keys]).on_conflict_do_nothing())
+    key_columns = [table.__table__.c[column] for column in columns]
+    rows = connection.execute(select(table.id, *key_columns).where(tuple_(*key_columns).in_(keys)))
+    return {tuple(row[1:]): row[0] for row in rows}
+
+def typed_rows(cars):
+    # scraped records as cars_cm2 rows: numeric year and mileage, lookup ids
+    frame = pd.DataFrame(list(cars), columns=list(CAR_COLUMNS))
+    if frame.empty:
+        return []
+    # If no UUID provided, generate one
+    frame['uuid'] = [value if isinstance(value, str) else str(uuid.uuid4()) for value in frame['uuid']]
+    year = normalize_year(frame['year'])
+    # the scrapers already scaled the mileage, reading it again must not multiply it
+    mileage = normalize_mileage(frame['mileage']).round().astype('Int64')
+    # a mileage that was scraped but can't be read as km is kept as text
+    frame['mileage_raw'] = frame['mileage'].astype(str).str[:30].where(mileage.isna() & frame['mileage'].notna())
+    frame['year'] = year
+    frame['mileage'] = mileage
+    frame['last_seen'] = frame['timestamp']
+    frame['source'] = [url_site(url) if isinstance(url, str) else None for url in frame['url']]
+    # the names keep their scraped spelling, the lookups go by the normalized one
+    for column in ('brand', 'model', 'color'):
+        frame[f'{column}_key'] = normalize_name(frame[column])
+    rows = to_records(frame)
+
+    # names are added in their own transaction, so parallel loaders don't wait on each other's files
+    with engine.begin() as connection:
+        sources = lookup_ids(connection, Source, {(row['source'],) for row in rows})
+        brands = lookup_ids(connection, Brand, {(row['brand_key'],) for row in rows})
+        colors = lookup_ids(connection, Color, {(row['color_key'],) for row in rows})
+        for row in rows:
+            row['source_id'] = sources.get((row.pop('source'),))
+            row['brand_id'] = brands.get((row.pop('brand_key'),))
+            row['color_id'] = colors.get((row.pop('color_key'),))
+        models = lookup_ids(connection, CarModel, {(row['brand_id'], row['model_key']) for row in rows},
+                            ('brand_id', 'name'))
+    for row in rows:
+        row['model_id'] = models.get((row['brand_id'], row.pop('model_key')))
+    partitions.ensure_partitions(engine, frame['timestamp'])
+    return rows
+
+def upsert_cars(cars, diff=None):
+    # one INSERT ... ON CONFLICT per batch, returns (inserted, updated)
+    # Postgres refuses to update the same row twice in one statement, the last scrape wins
+    rows = {row['uuid']: row for row in typed_rows(cars)}
+    if not rows:
+        return 0, 0
+
+    if diff is not None:
+        # the versions are worked out against cars_cm2 before the upsert changes it
+        session.execute(text(STAGING_DDL))
+        session.execute(text(f'TRUNCATE {STAGING_TABLE}'))
+        session.execute(insert(staging_table), list(rows.values()))
+        diff.add_chunk(session, rows.values())
+
+    statement = insert(Car).values(list(rows.values()))
+    statement = statement.on_conflict_do_update(
+        index_elements=[Car.uuid],
+        set_={**{column: statement.excluded[column] for column in UPSERT_COLUMNS}, 'removed_at': None},
+        # a file older than what the table has doesn't overwrite it
+        where=(statement.excluded.last_seen >= Car.last_seen).is_not(false())
+              & ((Car.removed_at == None) | (statement.excluded.last_seen > Car.removed_at)))
+    # a row is returned when it was inserted (xmax is 0) or updated, one the WHERE skipped is not
+    merged = [row[0] for row in session.execute(statement.returning(literal_column('xmax = 0')))]
+    inserted = sum(merged)
+    scrapes = [{column: row[column] for column in SCRAPE_COLUMNS} for row in rows.values() if row['timestamp']]
+    if scrapes:
+        session.execute(insert(CarScrape).values(scrapes).on_conflict_do_nothing())
+    return inserted, len(merged) - inserted
+
+# Read JSON Lines (.jsonl, .jsonl.gz, .jsonl.zst) or legacy JSON file
+def import_cars_from_json(filename, detect_removed=False):
+    # Keep track of new and refreshed cars
+    inserted_count = 0
+    updated_count = 0
+    diff = RunDiff()
+    detect_removed = detect_removed and complete_run(filename)
 
     try:
+        # records are streamed from the file, only one batch is in memory at a time
+        for batch in iter_batches(filename, batch_size):
+            inserted, updated = upsert_cars(batch, diff)
+            inserted_count += inserted
+            updated_count += updated
+        if detect_removed:
+            diff.mark_removed(session)
+
         # Commit the session
         session.commit()
-        print(f"Successfully imported {imported_count} new cars")
-        logger.info(f"Import completed. {imported_count} cars added")
+        print(f"Successfully imported {inserted_count} new cars, {updated_count} already known")
+        logger.info(f"Import completed. {inserted_count} cars added, {updated_count} updated")
+        logger.info(f"Changes in {filename}: {diff.summary()}")
     except Exception as e:
         session.rollback()
         print(f"Error importing data: {e}")
     finally:
         session.close()
+    return inserted_count, updated_count
+
+# Bulk load: records are streamed through COPY into a staging table and merged from there
+STAGING_TABLE = 'cars_staging'
+# GENERATED gives the staged rows their content_hash
+STAGING_DDL = f'CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} (LIKE cars_cm2 INCLUDING DEFAULTS INCLUDING GENERATED)'
+staging_table = table(STAGING_TABLE, *(column(name) for name in ROW_COLUMNS))
+copy_chunk_size = 50000
+
+def merge_query(on_conflict='update'):
+    columns = ', '.join(ROW_COLUMNS)
+    if on_conflict == 'update':
+        action = ('DO UPDATE SET ' + ', '.join(f'{column} = excluded.{column}' for column in UPSERT_COLUMNS)
+                  # a file older than what the table has doesn't overwrite it
+                  + ', removed_at = NULL WHERE (excluded.last_seen >= cars_cm2.last_seen) IS NOT FALSE '
+                  # nor brings back a removed listing it was scraped before the removal
+                  'AND (cars_cm2.removed_at IS NULL OR excluded.last_seen > cars_cm2.removed_at)')
+    else:
+        action = 'DO NOTHING'
+    # DISTINCT ON keeps one row per listing, the last scrape in the chunk
+    return (f'INSERT INTO cars_cm2 ({columns}) '
+            f'SELECT DISTINCT ON (uuid) {columns} FROM {STAGING_TABLE} ORDER BY uuid, last_seen DESC NULLS LAST '
+            f'ON CONFLICT (uuid) {action} RETURNING (xmax = 0)')
+
+# every row of the chunk, a scrape already in the history is left alone
+SCRAPES_QUERY = (f"INSERT INTO car_scrapes ({', '.join(SCRAPE_COLUMNS)}) "
+                 f"SELECT {', '.join(SCRAPE_COLUMNS)} FROM {STAGING_TABLE} WHERE timestamp IS NOT NULL "
+                 f"ON CONFLICT DO NOTHING")
+
+# Change data capture. Every staged listing is placed on its own version timeline at the
+# time it was scraped, so files loaded out of order (backfill) still get their versions:
+# - no version yet: a 'new' one from the scrape on
+# - scraped before its first version: a 'new' one up to it, or the first one starts earlier
+#   when nothing changed
+# - the version in effect then differs, or is a removal: it ends at the scrape and a
+#   'changed' or 'returned' one takes over until the next version
+def changes_query(on_conflict='update'):
+    # with on_conflict 'nothing' cars_cm2 keeps its rows, so only new listings are versioned
+    only_new = '' if on_conflict == 'update' else 'AND FALSE'
+    return f'''
+    WITH latest AS (
+        SELECT DISTINCT ON (uuid) * FROM {STAGING_TABLE} WHERE last_seen IS NOT NULL
+        ORDER BY uuid, last_seen DESC
+    ), placed AS (
+        SELECT s.*, v.id AS v_id, v.change AS v_change, v.content_hash AS v_hash, v.valid_to AS v_valid_to,
+            n.id AS n_id, n.content_hash AS n_hash, n.valid_from AS n_valid_from
+        FROM latest s
+        LEFT JOIN LATERAL (
+            SELECT id, change, content_hash, valid_to FROM listing_changes l
+            WHERE l.uuid = s.uuid AND l.valid_from <= s.last_seen ORDER BY l.valid_from DESC LIMIT 1
+        ) v ON TRUE
+        LEFT JOIN LATERAL (
+            SELECT id, content_hash, valid_from FROM listing_changes l
+            WHERE l.uuid = s.uuid AND l.valid_from > s.last_seen ORDER BY l.valid_from LIMIT 1
+        ) n ON TRUE
+    ), diff AS (
+        SELECT *, CASE WHEN v_id IS NULL THEN 'new' WHEN v_change = 'removed' THEN 'returned' ELSE 'changed' END
+            AS change,
+            CASE WHEN v_id IS NULL THEN n_valid_from ELSE v_valid_to END AS valid_to
+        FROM placed
+        WHERE (v_id IS NULL AND n_id IS NULL)
+           OR ((v_id IS NULL AND n_hash IS DISTINCT FROM content_hash) {only_new})
+           OR ((v_id IS NOT NULL AND (v_change = 'removed' OR v_hash IS DISTINCT FROM content_hash)) {only_new})
+    ), closed AS (
+        UPDATE listing_changes l SET valid_to = d.last_seen FROM diff d WHERE l.id = d.v_id
+    ), followed AS (
+        -- the old first version now follows the new one
+        UPDATE listing_changes l SET change = 'changed' FROM diff d
+        WHERE l.id = d.n_id AND d.v_id IS NULL AND l.change = 'new'
+    ), extended AS (
+        UPDATE listing_changes l SET valid_from = p.last_seen FROM placed p
+        WHERE l.id = p.n_id AND p.v_id IS NULL AND p.n_hash = p.content_hash
+    )
+    INSERT INTO listing_changes (uuid, change, {VERSION_COLUMNS}, valid_from, valid_to)
+    SELECT uuid, change, {VERSION_COLUMNS}, last_seen, valid_to FROM diff
+    RETURNING change'''
+
+# the versions of one listing are worked out by one loader at a time: staged uuids hash into
+# LOCK_BUCKETS transaction locks, taken in order so two loaders can't deadlock
+LOCK_BUCKETS = 256
+LOCK_CLASS = 7240025
+LOCK_QUERY = f'''
+    SELECT pg_advisory_xact_lock({LOCK_CLASS}, bucket) FROM (
+        SELECT DISTINCT hashtext(uuid) & {LOCK_BUCKETS - 1} AS bucket FROM {STAGING_TABLE} ORDER BY bucket
+    ) buckets'''
+ALL_LOCKS_QUERY = (f'SELECT pg_advisory_xact_lock({LOCK_CLASS}, bucket) '
+                   f'FROM generate_series(0, {LOCK_BUCKETS - 1}) bucket')
+
+# the chunk's scrape time range and how many listings it has
+CHUNK_QUERY = f'SELECT min(last_seen), max(last_seen), count(DISTINCT uuid) FROM {STAGING_TABLE}'
+
+# listings of the (source, brand) pairs a full run covered that were last seen before the run
+REMOVED_QUERY = f'''
+    WITH scope AS (
+        SELECT * FROM unnest(CAST(:sources AS smallint[]), CAST(:brands AS smallint[])) AS scope (source_id, brand_id)
+    ), gone AS (
+        UPDATE cars_cm2 c SET removed_at = :removed_at FROM scope s
+        WHERE c.source_id = s.source_id AND c.brand_id = s.brand_id
+          AND c.removed_at IS NULL AND coalesce(c.last_seen, c.timestamp) < :run_started
+        RETURNING c.*
+    ), closed AS (
+        UPDATE listing_changes l SET valid_to = :removed_at FROM gone g
+        WHERE l.uuid = g.uuid AND l.valid_to IS NULL
+    )
+    INSERT INTO listing_changes (uuid, change, {VERSION_COLUMNS}, valid_from)
+    SELECT uuid, 'removed', {VERSION_COLUMNS}, :removed_at FROM gone'''
+
+def complete_run(filename):
+    # removals are only worked out from a run that covered every page of its brands
+    info = read_run_info(filename)
+    if info is None:
+        logger.warning(f"{filename} has no run info, not marking missing listings as removed")
+        return False
+    if not info['complete']:
+        logger.warning(f"{filename} is not a complete run ({'; '.join(info['incomplete'][:5])}), "
+                       f"not marking missing listings as removed")
+        return False
+    return True
+
+class RunDiff:
+    """New, changed, returned, removed and unchanged listings of one ingest run."""
+
+    def __init__(self, on_conflict='update'):
+        self.changes_query = text(changes_query(on_conflict))
+        self.counts = Counter()
+        self.listings = 0
+        self.scope = set()
+        self.run_started = None
+        self.run_finished = None
+
+    def add_chunk(self, connection, rows):
+        # connection is anything with execute(): the session, or a SQLAlchemy connection;
+        # the locks are held until the chunk is merged and committed
+        connection.execute(text(LOCK_QUERY)).fetchall()
+        self.counts.update(row[0] for row in connection.execute(self.changes_query))
+        first, last, listings = connection.execute(text(CHUNK_QUERY)).one()
+        self.listings += listings
+        self.run_started = min(filter(None, (self.run_started, first)), default=None)
+        self.run_finished = max(filter(None, (self.run_finished, last)), default=None)
+        self.scope.update((row['source_id'], row['brand_id']) for row in rows
+                          if row['source_id'] is not None and row['brand_id'] is not None)
+
+    def mark_removed(self, connection):
+        # only for a run that scraped every page of its brands, a partial one would remove the rest
+        if not self.scope or self.run_started is None:
+            return 0
+        connection.execute(text(ALL_LOCKS_QUERY)).fetchall()
+        sources, brands = zip(*sorted(self.scope))
+        removed = connection.execute(text(REMOVED_QUERY), {
+            'sources': list(sources), 'brands': list(brands),
+            'run_started': self.run_started, 'removed_at': self.run_finished}).rowcount
+        self.counts['removed'] += removed
+        return removed
+
+    def summary(self):
+        versioned = self.counts['new'] + self.counts['changed'] + self.counts['returned']
+        return (f"{self.counts['new']} new, {self.counts['changed']} changed, {self.counts['returned']} returned, "
+                f"{self.counts['removed']} removed, {max(self.listings - versioned, 0)} unchanged")
+
+def copy_rows(cursor, cars):
+    # one CSV buffer per chunk, None becomes an empty field which COPY reads as NULL
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    rows = typed_rows(cars)
+    for row in rows:
+        writer.writerow([row[column] for column in ROW_COLUMNS])
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {STAGING_TABLE} ({', '.join(ROW_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    return rows
+
+def bulk_import_cars(filename, chunk_size=None, on_conflict='update', detect_removed=False):
+    # COPY + INSERT ... ON CONFLICT per chunk, returns (inserted, updated, records copied);
+    # detect_removed marks listings of the file's brands it didn't have as removed,
+    # when the file's run info says it is a complete, non-incremental run
+    chunk_size = chunk_size or copy_chunk_size
+    started = datetime.now()
+    inserted_count = 0
+    updated_count = 0
+    merged_count = 0
+    diff = RunDiff(on_conflict)
+    detect_removed = detect_removed and complete_run(filename)
+    # the COPY goes through the raw psycopg2 cursor, the rest through the same connection
+    with engine.connect() as connection:
+        cursor = connection.connection.cursor()
+        try:
+            connection.execute(text(STAGING_DDL))
+            connection.commit()
+            # records are streamed from the file, only one chunk is in memory at a time
+            for chunk in iter_batches(filename, chunk_size):
+                connection.execute(text(f'TRUNCATE {STAGING_TABLE}'))
+                rows = copy_rows(cursor, chunk)
+                diff.add_chunk(connection, rows)
+                merged = [row[0] for row in connection.execute(text(merge_query(on_conflict)))]
+                connection.execute(text(SCRAPES_QUERY))
+                # every chunk is its own transaction, a failure keeps the chunks before it
+                connection.commit()
+                inserted_count += sum(merged)
+                updated_count += len(merged) - sum(merged)
+                merged_count += len(rows)
+                logger.info(f"{merged_count} records copied, {inserted_count} new so far")
+            if detect_removed:
+                diff.mark_removed(connection)
+                connection.commit()
+        except Exception as e:
+            connection.rollback()
+            logger.error(f"Bulk import of {filename} failed after {merged_count} records: {e}")
+            raise
+
+    elapsed = (datetime.now() - started).total_seconds()
+    logger.info(f"Bulk import of {filename} done: {merged_count} records, {inserted_count} new, "
+                f"{updated_count} updated in {elapsed:.1f}s "
+                f"({merged_count / elapsed if elapsed else 0:.0f} rows/sec)")
+    logger.info(f"Changes in {filename}: {diff.summary()}")
+    return inserted_count, updated_count, merged_count
+
+# Re-clean the mileage junk kept in mileage_raw with normalize.py
+def reclean_mileage(batch_size=10000):
+    updated_count = 0
+    query = ('SELECT uuid, mileage_raw FROM cars_cm2 '
+             'WHERE mileage IS NULL AND mileage_raw IS NOT NULL ORDER BY uuid')
+    with engine.connect() as connection:
+        for chunk in pd.read_sql(query, connection, chunksize=batch_size):
+            # no unit guessing from the year, the same as the typed migration
+            cleaned = normalize_mileage(chunk['mileage_raw']).round().astype('Int64')
+            # text that still can't be read stays in mileage_raw
+            changed = chunk[cleaned.notna()].assign(mileage=cleaned[cleaned.notna()].astype(int), mileage_raw=None)
+            session.bulk_update_mappings(Car, changed[['uuid', 'mileage', 'mileage_raw']].to_dict('records'))
+            session.commit()
+            updated_count += len(changed)
+            logger.info(f"Re-cleaned {updated_count} mileages so far")
+    session.close()
+    return updated_count
 
 # Usage
-#bulk_import_cars('cars_list.json')
-import_cars_from_json('car_list_motorgy.json')
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load scrape output files into cars_cm2')
+    parser.add_argument('files', nargs='*', default=['car_list_motorgy.jsonl'])
+    parser.add_argument('--mode', choices=['bulk', 'upsert'], default='bulk',
+                        help='bulk streams through COPY, upsert inserts batches with the ORM session')
+    parser.add_argument('--chunk-size', type=int, default=copy_chunk_size)
+    parser.add_argument('--on-conflict', choices=['update', 'nothing'], default='update',
+                        help='what bulk mode does with listings already in the table')
+    parser.add_argument('--detect-removed', action='store_true',
+                        help='mark listings of the brands in a file that it lacks as removed, '
+                             'only done for files whose run info says they are complete')
+    parser.add_argument('--no-refresh', action='store_true', help="don't refresh the dashboard views after loading")
+    parser.add_argument('--reclean-mileage', action='store_true', help='move mileage_raw text normalize.py can read into mileage and exit')
+    args = parser.parse_args()
+
+    migrate()
+    if args.reclean_mileage:
+        reclean_mileage()
+    else:
+        for filename in args.files:
+            if args.mode == 'bulk':
+                bulk_import_cars(filename, args.chunk_size, args.on_conflict, detect_removed=args.detect_removed)
+            else:
+                import_cars_from_json(filename, detect_removed=args.detect_removed)
+        if not args.no_refresh:
+            market_views.refresh_views(engine)
\ No newline at end of file
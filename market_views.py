@@ -0,0 +1,98 @@
+import argparse
+import logging
+from datetime import datetime
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# car_origin as the dashboard assigns it, every other brand is 'other'
+ORIGINS = {
+    'german': ('bmw', 'porsche', 'mercedes', 'volkswagen'),
+    'american': ('chevrolet', 'dodge', 'gmc', 'ford', 'jeep'),
+    'japanese': ('toyota', 'nissan', 'honda', 'lexus'),
+    'chinese': ('chery', 'geely', 'mg'),
+    'korean': ('kia', 'hyundai'),
+}
+# the dashboard leaves out prices that are placeholders rather than asking prices
+PRICE_FILTER = 'price > 1 AND price < 100000 AND price <> 1111'
+
+
+def origin_case():
+    whens = ' '.join(f"WHEN lower(brand) IN ({', '.join(repr(brand) for brand in brands)}) THEN '{origin}'"
+                     for origin, brands in ORIGINS.items())
+    return f"CASE {whens} ELSE 'other' END"
+
+
+# dashboard/utils.process_data computed in Postgres: median mileage and price and the
+# listing count per brand/model/color/year, and z-scores of the medians within each brand
+# (stddev_pop, like scipy.stats.zscore)
+MARKET_GROUPS = f'''
+    CREATE MATERIALIZED VIEW IF NOT EXISTS market_groups AS
+    WITH groups AS (
+        SELECT brand, model, color, year, {origin_case()} AS car_origin,
+            coalesce(percentile_cont(0.5) WITHIN GROUP (ORDER BY mileage), 0) AS median_mileage,
+            percentile_cont(0.5) WITHIN GROUP (ORDER BY price) AS median_price,
+            count(*) AS count
+        FROM cars_cm2
+        WHERE {PRICE_FILTER}
+          AND brand IS NOT NULL AND model IS NOT NULL AND color IS NOT NULL AND year IS NOT NULL
+        GROUP BY brand, model, color, year
+    )
+    SELECT *,
+        (median_mileage - avg(median_mileage) OVER by_brand) / nullif(stddev_pop(median_mileage) OVER by_brand, 0)
+            AS mileage_zscore,
+        (median_price - avg(median_price) OVER by_brand) / nullif(stddev_pop(median_price) OVER by_brand, 0)
+            AS price_zscore
+    FROM groups
+    WINDOW by_brand AS (PARTITION BY brand)'''
+
+# the id column is only there for the unique index a concurrent refresh needs
+MARKET_SUMMARY = f'''
+    CREATE MATERIALIZED VIEW IF NOT EXISTS market_summary AS
+    SELECT 1 AS id, count(*) AS total_cars, max(timestamp) AS last_scrape
+    FROM cars_cm2 WHERE {PRICE_FILTER}'''
+
+VIEWS = {
+    'market_groups': (MARKET_GROUPS, 'CREATE UNIQUE INDEX IF NOT EXISTS market_groups_key '
+                                     'ON market_groups (brand, model, color, year)'),
+    'market_summary': (MARKET_SUMMARY, 'CREATE UNIQUE INDEX IF NOT EXISTS market_summary_key ON market_summary (id)'),
+}
+
+
+def create_views(connection):
+    # a view is filled when it is created, so it can be refreshed concurrently from then on
+    for view, index in VIEWS.values():
+        connection.execute(text(view))
+        connection.execute(text(index))
+
+
+def drop_views(connection):
+    for name in VIEWS:
+        connection.execute(text(f'DROP MATERIALIZED VIEW IF EXISTS {name}'))
+
+
+def refresh_views(engine):
+    # CONCURRENTLY keeps the old rows readable by the dashboard while the new ones are computed
+    for name in VIEWS:
+        started = datetime.now()
+        with engine.begin() as connection:
+            connection.execute(text(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {name}'))
+        logger.info(f"Refreshed {name} in {(datetime.now() - started).total_seconds():.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Materialized views with the dashboard aggregates')
+    parser.add_argument('command', choices=['refresh', 'recreate'],
+                        help='recreate drops and rebuilds the views after their definition changed')
+    args = parser.parse_args()
+
+    import insert_into_db as db
+    if args.command == 'recreate':
+        with db.engine.begin() as connection:
+            drop_views(connection)
+            create_views(connection)
+    else:
+        with db.engine.begin() as connection:
+            create_views(connection)
+        refresh_views(db.engine)
@@ -2,10 +2,11 @@ from playwright.async_api import Playwright, async_playwright
 import asyncio
 import random
 import safe_scrape as ss
-import time
+import html_archive
+import parsers
+from scrape_sink import JsonlSink, write_pages_in_order
+from crawl_state import Checkpoint, IncrementalCrawl, SeenIndex, write_new_page
 import logging
-import json
-import uuid
 from datetime import datetime
 
 
@@ -31,37 +32,56 @@ user_agent = random.choice(user_agents)
 playwright = async_playwright()
 url = 'https://www.motorgy.com/en/used-cars'
 
+# 'url' opens pages directly by number (pn=) in parallel tabs, 'click' follows the next button
+pagination_mode = 'url'
+# number of tabs fetching pages at the same time in 'url' mode
+page_concurrency = 4
+max_page_concurrency = 8
+# attempts after the first one for a page that timed out, was throttled or came back empty
+retries = 3
+# skip images, fonts, media and trackers, see safe_scrape.ResourcePolicy
+block_resources = True
+# None, 'gzip' or 'zstd' for the JSON Lines output
+output_compression = None
+# only write listings not seen in earlier runs and stop paginating once
+# stop_after_known_pages pages in a row had nothing new (crawl_state.db)
+incremental = False
+stop_after_known_pages = 1
+# save progress after every page and pick up an unfinished run where it stopped
+resume = True
+# store the html of every listing page in the content-addressed archive
+archive_html = True
+
 current_datetime = datetime.now()
 timestamp = current_datetime.strftime('%Y%m%d')
 
+async def last_page_number(page):
+    # the last active pagination link carries the highest page number in its href
+    pagination_div = await page.query_selector('#pagingDiv')
+    if not pagination_div:
+        return None
+    active_links = await page.query_selector_all('a.activeLink')  # Get all active links
+    if not active_links:
+        return None
+    href = await active_links[-1].get_attribute('href')
+    if not href or 'pn=' not in href:
+        return None
+    return int(href.split('pn=')[1])
+
+
 async def check_last_page(page):
     try:
-        #print("Finding pagination div...")
-        pagination_div = await page.query_selector('#pagingDiv')
-        
-        if pagination_div:
-            #print("Finding last active link...")
-            active_links = await page.query_selector_all('a.activeLink')  # Get all active links
-            if active_links:
-                last_active_link = active_links[-1]  # Get the last one
-                #print("Getting href attribute...")
-                href = await last_active_link.get_attribute('href')
-                
-                if href:
-                    #print(f"Found href: {href}")
-                    # Extract page number from href
-                    last_page_number = int(href.split('pn=')[1])
-                    #print(f"Last page number: {last_page_number}")
-                    
-                    # Get current page number
-                    current_url = page.url
-                    current_page = int(current_url.split('pn=')[1]) if 'pn=' in current_url else 1
-                    #print(f"Current page: {current_page}")
-                    
-                    is_last_page = current_page >= last_page_number
-                    #print(f"Is last page: {is_last_page}")
-                    
-                    return current_page, is_last_page
+        last_page = await last_page_number(page)
+        if last_page is not None:
+            # Get current page number
+            current_url = page.url
+            current_page = int(current_url.split('pn=')[1]) if 'pn=' in current_url else 1
+            #print(f"Current page: {current_page}")
+
+            is_last_page = current_page >= last_page
+            #print(f"Is last page: {is_last_page}")
+
+            return current_page, is_last_page
     
         return 1, False
         
@@ -69,120 +89,203 @@ async def check_last_page(page):
         print(f"Error in check_last_page at position: {str(e)}")
         return 1, False
 
-def to_json_file(data, filename):
+# Pulls the raw text of every listing card in the browser, returns plain dicts
+CARD_FIELDS_JS = """
+cards => cards.map(card => {
+    const text = (selector) => {
+        const el = card.querySelector(selector);
+        return el ? el.textContent : null;
+    };
+    const title = card.querySelector('.card-title .ff-semiBold.fs-16.color_title');
+    // these are nested tags, the price sits in the last container
+    const priceContainers = card.querySelectorAll('.d-flex.justify-content-between');
+    const lastContainer = priceContainers.length ? priceContainers[priceContainers.length - 1] : null;
+    const priceSpan = lastContainer ? lastContainer.querySelector('.color_title.ff-semiBold.fs-16') : null;
+    return {
+        name: title ? title.textContent : null,
+        url: title ? title.getAttribute('href') : null,
+        year: text('.feature-cars-year.me-2.ff-semiBold.fs-12.color_title'),
+        mileage: text('.feature-cars-KM.ff-semiBold.me-2.fs-12.color_subtitle'),
+        price: priceSpan ? priceSpan.innerText : null
+    };
+})
+"""
+
+
+def page_url(page_num):
+    return f'{url}?pn={page_num}'
+
+
+async def scrape_cards(page, current_page):
+    await page.wait_for_selector('.card-body', state='visible', timeout=30000)
+    # one round trip for the whole page instead of several awaits per card
+    cars = await page.eval_on_selector_all('.card-body', CARD_FIELDS_JS)
+    if not cars:
+        raise ss.EmptyPage(f'no cards on page {current_page}')
+    if archive_html:
+        # kept so the page can be re-parsed later without scraping it again
+        html_archive.default_archive().store(await page.content(), 'motorgy', 'all', current_page, page.url)
+    logger.info("Found %d cars on page %d ", len(cars), current_page)
+    return [car_dict for car_dict in (parsers.parse_motorgy_card(car, current_page, timestamp) for car in cars) if car_dict is not None]
+
+
+async def scrape_page(context, concurrency, page_num, sink=None):
+    async def attempt():
+        page = await context.new_page()
+        try:
+            await ss.goto(page, page_url(page_num))
+            return await scrape_cards(page, page_num)
+        finally:
+            await page.close()
+
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            file_data = json.load(f)
-    except:
-        file_data = []
-    
-    file_data.append(data)
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(file_data, f, indent=4)
-    return filename
+        cars = await ss.with_retries(attempt, retries, concurrency, f'page {page_num}')
+    except Exception as e:
+        # one bad page should not cost the rest of the run
+        logger.error('Giving up on page %d: %s', page_num, e)
+        if sink:
+            sink.mark_incomplete(f'page {page_num} failed')
+        cars = []
+    return page_num, cars
+
+
+async def scrape_by_url(context, page, last_page, sink, crawl=None, first_page=1, on_page=None):
+    # first_page is already open, the rest fan out over a bounded set of tabs
+    cars_scraped = write_new_page(sink, await scrape_cards(page, first_page), crawl)
+    if on_page:
+        on_page(first_page)
+    concurrency = ss.AdaptiveConcurrency(page_concurrency, maximum=max_page_concurrency)
+    if crawl is None:
+        tasks = [scrape_page(context, concurrency, n, sink) for n in range(first_page + 1, last_page + 1)]
+        cars_scraped += await write_pages_in_order(sink, tasks, first_page=first_page + 1, on_page=on_page)
+    else:
+        # incremental runs go one batch of tabs at a time so they can stop early
+        start = first_page + 1
+        while start <= last_page:
+            if crawl.should_stop:
+                logger.info('Only known listings on the last %d pages, stopping', crawl.known_pages)
+                break
+            batch = range(start, min(start + concurrency.limit, last_page + 1))
+            for page_num, cars in await asyncio.gather(*(scrape_page(context, concurrency, n, sink) for n in batch)):
+                if not crawl.should_stop:
+                    cars_scraped += write_new_page(sink, cars, crawl)
+                    if on_page:
+                        on_page(page_num)
+            start = batch.stop
+    logger.info('total cars scraped: %d over %d pages', cars_scraped, last_page)
+    return cars_scraped
+
+
+async def scrape_by_click(page, sink, crawl=None, on_page=None, stop_page=None):
+    #two_word_brands = ['Land Rover', 'Aston Martin', 'Alfa Romeo', 'Great Wall']
+    # Land Rover, Aston Martin, Alfa Romeo, Great Wall
+    cars_scraped = 0
+    while True:
+        await ss.with_retries(lambda: page.wait_for_selector('.card-body', state='visible', timeout=30000),
+                              retries, description='listing page')
+        current_page, last_page = await check_last_page(page)
+        cars = await scrape_cards(page, current_page)
+        #next_button =  page.locator('#pagingDiv a.disableLink[href*="pn="]')
+        next_button = await page.locator('a:has-text("»"):last-child').element_handle()
+        cars_scraped += write_new_page(sink, cars, crawl)
+        if on_page:
+            on_page(current_page)
+
+        if last_page or (stop_page and current_page >= stop_page):
+            break
+        elif crawl and crawl.should_stop:
+            logger.info('Only known listings on the last %d pages, stopping', crawl.known_pages)
+            break
+        else:
+            logger.info('total cars scraped: %d', cars_scraped)
+            await next_button.scroll_into_view_if_needed()
+
+            # waits for this host's turn without freezing the event loop
+            await ss.human_pause(page)
+            await next_button.click()
+            #print(await response.status)
+    return cars_scraped
+
+
+async def scrape_range(browser, sink, crawl=None, on_page=None, start_page=1, stop_page=None):
+    # pages start_page to stop_page (the last one by default) into sink, in a context of their own
+    start_url = page_url(start_page) if start_page > 1 else url
+    if crawl:
+        sink.mark_incomplete('incremental crawl, only new listings')
+    context = await browser.new_context(viewport={"width": 1600, "height": 900},
+                                user_agent=user_agent,
+                                locale='en-US',
+                                timezone_id='America/New_York'
+                                #geolocation={'longitude': 59.913034295248146, 'latitude':  10.760390096262885},
+                                #permissions=['geolocation']
+                                )
+    policy = await ss.apply_resource_policy(context) if block_resources else None
+    try:
+        page = await context.new_page()
+        await ss.with_retries(lambda: ss.goto(page, start_url), retries, description='first page')
+
+        last_page = await last_page_number(page) if pagination_mode == 'url' else None
+        if last_page and stop_page:
+            last_page = min(last_page, stop_page)
+        if last_page and start_page > last_page:
+            logger.info('Nothing left to scrape after page %d', last_page)
+            cars_scraped = 0
+        elif last_page:
+            logger.info('Found %d pages, fetching them %d at a time', last_page, page_concurrency)
+            cars_scraped = await scrape_by_url(context, page, last_page, sink, crawl,
+                                               first_page=start_page, on_page=on_page)
+        else:
+            cars_scraped = await scrape_by_click(page, sink, crawl, on_page=on_page, stop_page=stop_page)
+    finally:
+        await context.close()
+        if policy:
+            logger.info('Resource policy: %s', policy.report())
+    return cars_scraped
+
 
 ## add logging and debugging
 async def run():
-    async with async_playwright() as playwright:
-        browser = await playwright.chromium.launch(headless=True)
-        context = await browser.new_context(viewport={"width": 1600, "height": 900},
-                                    user_agent=user_agent,
-                                    locale='en-US',
-                                    timezone_id='America/New_York'
-                                    #geolocation={'longitude': 59.913034295248146, 'latitude':  10.760390096262885},
-                                    #permissions=['geolocation']
-                                    )
-        page = await context.new_page()
-        await page.goto(url,  timeout=60000, wait_until='load')
-
-        car_dict = {}
-        car_list = []
-        #two_word_brands = ['Land Rover', 'Aston Martin', 'Alfa Romeo', 'Great Wall']
-        # Land Rover, Aston Martin, Alfa Romeo, Great Wall
-        cars_scraped = 0
-        while True:
-            await page.wait_for_selector('.card-body', state='visible', timeout=30000)
-            cars = await page.query_selector_all('.card-body')
-            #next_button =  page.locator('#pagingDiv a.disableLink[href*="pn="]')
-            next_button = await page.locator('a:has-text("»"):last-child').element_handle()
-            current_page, last_page = await check_last_page(page)
-
-            
-
-            logger.info("Found %d cars on page %d ", len(cars), current_page)
-
-            
-
-            for car in cars:
-                card_title_check = await car.query_selector('.card-title')
-                
-                # these are nested tags
-                price_containers = await car.query_selector_all('.d-flex.justify-content-between')
-                #print(price_containers)
-
-                if price_containers:
-                    last_container = price_containers[-1]
-                    price_span = await last_container.query_selector('.color_title.ff-semiBold.fs-16')
-                    
-                    if price_span:
-                        price_text = await price_span.inner_text()
-                        #prices.append(price_text)
-                        #print(price_text)
-
-                if card_title_check:
-                    name = await card_title_check.query_selector('.ff-semiBold.fs-16.color_title')
-                    link = await name.get_attribute('href')
-                    name = await name.text_content()
-                    split_names = name.split('؜')
-                    brand = split_names[0]
-                    model = ''.join(split_names[1:]) #split_names[1]
-                    year = await car.query_selector('.feature-cars-year.me-2.ff-semiBold.fs-12.color_title')
-                    year = await year.text_content()
-                    mileage = await car.query_selector('.feature-cars-KM.ff-semiBold.me-2.fs-12.color_subtitle')
-                    mileage = await mileage.text_content()
-                
-
-                    car_dict ={
-                    'uuid': str(uuid.uuid4()),
-                    'url': link,
-                    'brand': brand.strip().replace('-', ' '),
-                    'page':current_page,
-                    'timestamp': timestamp,
-                    'model': model.strip().replace('-', ' '),
-                    'year': year,
-                    'mileage':mileage.strip().replace(',', '').split()[0],
-                    'color':None,
-                    'price': price_text.replace(',', '').split()[0]
-                    }
-                    #print(name)
-                    car_list.append(car_dict)
-            if last_page:
-                break
-            else:
-                #print(str(await next_button.count()))
-                #await next_button.scroll_into_view_if_needed()
-                cars_scraped += len(cars)   
-                logger.info('total cars scraped: %d', cars_scraped)
-                time.sleep(random.uniform(1.5,2.5))
-
-                x,y = ss.random_mouse_movement()
-                await page.mouse.move(x, y)
-                await page.wait_for_timeout(random.randint(300, 800))
-                await next_button.scroll_into_view_if_needed()
-                delay = ss.random_delay(1.5,3)
-
-                await page.wait_for_timeout(delay * 1000)
-                await next_button.click()
-                #print(await response.status)
-                continue
-           
-
-    to_json_file(car_list, 'car_list_motorgy.json')
-    await browser.close()
-    logging.info('Scraping motorgy done. Check output file')
-    #print(car_list)
+    # pages already written stay in the file even when the run fails halfway
+    # in incremental mode only new listings are written and pagination stops early
+    # with resume on, progress is saved after every page and a crashed run picks up where it stopped
+    seen_index = SeenIndex() if incremental else None
+    crawl = IncrementalCrawl(seen_index, 'motorgy', 'all', stop_after_known_pages) if seen_index else None
+    checkpoint = Checkpoint() if resume else None
+    if checkpoint:
+        sink, start_page = checkpoint.open_sink('motorgy', 'all', 'car_list_motorgy.jsonl', compression=output_compression)
+        on_page = lambda page_num: checkpoint.save('motorgy', 'all', page_num, sink)
+    else:
+        sink, start_page = JsonlSink('car_list_motorgy.jsonl', compression=output_compression), 1
+        on_page = None
+    if start_page > 1:
+        logger.info('Resuming from page %d into %s', start_page, sink.filename)
 
+    try:
+        async with async_playwright() as playwright:
+            browser = await playwright.chromium.launch(headless=True)
+            try:
+                cars_scraped = await scrape_range(browser, sink, crawl, on_page, start_page=start_page)
+            finally:
+                await browser.close()
+    except Exception as e:
+        # the .part file keeps the pages already written for the next run to resume
+        sink.mark_incomplete(f'failed: {e}')
+        sink.close(finished=checkpoint is None)
+        if checkpoint:
+            checkpoint.close()
+        raise
+    finally:
+        if seen_index:
+            seen_index.close()
+
+    sink.close()
+    if checkpoint:
+        checkpoint.finish('motorgy', 'all')
+        checkpoint.close()
+    logging.info('Scraping motorgy done. %d cars written to %s', sink.records_written, sink.filename)
+    #print(car_list)
+    return cars_scraped
 
-            
-asyncio.run(run())
 
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import logging
+import random
+from datetime import datetime
+from urllib.parse import urljoin
+
+import httpx
+from selectolax.parser import HTMLParser
+
+import safe_scrape as ss
+import html_archive
+import parsers
+from scrape_sink import JsonlSink, iter_records, write_pages_in_order
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('motorgy_scrape_log.log'),
+        logging.StreamHandler()
+    ]
+)
+
+logger = logging.getLogger(__name__)
+
+user_agents = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Edge/120.0.0.0',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+]
+
+user_agent = random.choice(user_agents)
+base_url = 'https://www.motorgy.com'
+url = base_url + '/en/used-cars'
+
+# requests in flight at the same time, also the size of the keep-alive pool;
+# it starts at half and adapts to the site up to this
+concurrency = 8
+# attempts after the first one for a fetch that timed out or was throttled
+retries = 3
+# store the html of every listing page in the content-addressed archive
+archive_html = True
+
+timestamp = datetime.now().strftime('%Y%m%d')
+
+
+class BrowserFallback:
+    """Renders pages with Playwright for the ones the plain http fetch can't read.
+
+    The browser is only started the first time it is needed.
+    """
+
+    def __init__(self):
+        self._playwright = None
+        self._browser = None
+        self._lock = asyncio.Lock()
+
+    async def fetch(self, page_url, selector):
+        async with self._lock:
+            if self._browser is None:
+                from playwright.async_api import async_playwright
+                self._playwright = await async_playwright().start()
+                self._browser = await self._playwright.chromium.launch(headless=True)
+                logger.info('Started the browser fallback')
+        page = await self._browser.new_page(user_agent=user_agent, locale='en-US')
+        try:
+            await ss.apply_resource_policy(page)
+            await page.goto(page_url, timeout=60000, wait_until='load')
+            await page.wait_for_selector(selector, state='visible', timeout=30000)
+            return await page.content()
+        finally:
+            await page.close()
+
+    async def close(self):
+        if self._browser is not None:
+            await self._browser.close()
+            await self._playwright.stop()
+
+
+class Fetcher:
+    """Async http client with a keep-alive connection pool, Playwright as fallback."""
+
+    def __init__(self, max_connections=concurrency, timeout=30):
+        self.client = httpx.AsyncClient(
+            headers={'User-Agent': user_agent, 'Accept-Language': 'en-US,en;q=0.9'},
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections),
+            timeout=timeout,
+            follow_redirects=True)
+        self.concurrency = ss.AdaptiveConcurrency(max(1, max_connections // 2), maximum=max_connections)
+        self.fallback = BrowserFallback()
+        self.fallbacks = 0
+
+    async def fetch(self, page_url, selector):
+        # selector is what the page must contain, without it the page needs javascript
+        return await ss.with_retries(lambda: self._fetch(page_url, selector), retries, self.concurrency, page_url)
+
+    async def _fetch(self, page_url, selector):
+        await ss.limiter.acquire(page_url)
+        response = await self.client.get(page_url)
+        response.raise_for_status()
+        html = response.text
+        if HTMLParser(html).css_first(selector) is not None:
+            return html
+        logger.info('%s has no %s without javascript, using the browser', page_url, selector)
+        self.fallbacks += 1
+        html = await self.fallback.fetch(page_url, selector)
+        if HTMLParser(html).css_first(selector) is None:
+            raise ss.EmptyPage(f'{page_url} has no {selector}')
+        return html
+
+    async def close(self):
+        await self.client.aclose()
+        await self.fallback.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+def page_url(page_num):
+    return f'{url}?pn={page_num}'
+
+
+def to_records(cards, page_num):
+    return [car_dict for car_dict in (parsers.parse_motorgy_card(card, page_num, timestamp) for card in cards)
+            if car_dict is not None]
+
+
+def archive_page(html, page_num, fetched_url):
+    if archive_html:
+        # kept so the page can be re-parsed later without fetching it again
+        html_archive.default_archive().store(html, 'motorgy', 'all', page_num, fetched_url)
+
+
+async def scrape_page(fetcher, page_num, sink=None):
+    try:
+        html = await fetcher.fetch(page_url(page_num), '.card-body')
+        archive_page(html, page_num, page_url(page_num))
+        cards = parsers.extract_motorgy_cards(html)
+        if not cards:
+            raise ss.EmptyPage(f'no cards on page {page_num}')
+    except Exception as e:
+        # one bad page should not cost the rest of the run
+        logger.error('Giving up on page %d: %s', page_num, e)
+        if sink:
+            sink.mark_incomplete(f'page {page_num} failed')
+        return page_num, []
+    logger.info("Found %d cars on page %d ", len(cards), page_num)
+    return page_num, to_records(cards, page_num)
+
+
+async def scrape_listings(output='car_list_motorgy.jsonl'):
+    # same records and output file as motorgy.run(), without a browser per page
+    started = datetime.now()
+    async with Fetcher() as fetcher:
+        first_page = await fetcher.fetch(url, '.card-body')
+        archive_page(first_page, 1, url)
+        last_page = parsers.motorgy_last_page(first_page) or 1
+        logger.info('Found %d pages, fetching them %d at a time', last_page, concurrency)
+        with JsonlSink(output) as sink:
+            sink.write_page(to_records(parsers.extract_motorgy_cards(first_page), 1))
+            tasks = [scrape_page(fetcher, n, sink) for n in range(2, last_page + 1)]
+            await write_pages_in_order(sink, tasks, first_page=2)
+        fallbacks = fetcher.fallbacks
+
+    elapsed = (datetime.now() - started).total_seconds()
+    logger.info('Scraping motorgy done. %d cars from %d pages in %.0fs (%d browser fallbacks), written to %s',
+                sink.records_written, last_page, elapsed, fallbacks, sink.filename)
+    return sink.records_written
+
+
+async def scrape_details(urls, output='car_details_motorgy.jsonl'):
+    async def scrape_one(fetcher, detail_url):
+        html = await fetcher.fetch(detail_url, '.data-table__row')
+        return {
+            'url': detail_url,
+            'site': 'motorgy',
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'details': parsers.parse_motorgy_details(html),
+        }
+
+    urls = list(dict.fromkeys(urljoin(base_url, detail_url) for detail_url in urls))
+    async with Fetcher() as fetcher:
+        with JsonlSink(output) as sink:
+            for task in asyncio.as_completed([scrape_one(fetcher, detail_url) for detail_url in urls]):
+                try:
+                    sink.write_page([await task])
+                except Exception as e:
+                    logger.error('Detail scrape failed: %s', e)
+    logger.info('%d of %d detail pages written to %s', sink.records_written, len(urls), sink.filename)
+    return sink.records_written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Scrape motorgy over plain http, falling back to Playwright')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    listings = subparsers.add_parser('listings', help='scrape every used-cars listing page')
+    listings.add_argument('--output', default='car_list_motorgy.jsonl')
+
+    details = subparsers.add_parser('details', help='scrape car-details pages')
+    details.add_argument('files', nargs='+', help='list scrape output files to take urls from')
+    details.add_argument('--output', default='car_details_motorgy.jsonl')
+
+    parse = subparsers.add_parser('parse', help='parse a saved html file offline and print the records')
+    parse.add_argument('html_file')
+    parse.add_argument('--details', action='store_true', help='the file is a car-details page')
+
+    args = parser.parse_args()
+    if args.command == 'listings':
+        asyncio.run(scrape_listings(args.output))
+    elif args.command == 'details':
+        urls = (record['url'] for filename in args.files for record in iter_records(filename) if record.get('url'))
+        asyncio.run(scrape_details(urls, args.output))
+    else:
+        with open(args.html_file, encoding='utf-8') as f:
+            html = f.read()
+        if args.details:
+            print(parsers.parse_motorgy_details(html))
+        else:
+            print('last page:', parsers.motorgy_last_page(html))
+            for record in to_records(parsers.extract_motorgy_cards(html), 1):
+                print(record)
@@ -21,6 +21,42 @@ playwright = async_playwright()
 ### internal page motorgy
 url = 'https://www.motorgy.com/en/car-details/dodge-charger-%D8%9Crt/47968'
 
+# skip images, fonts, media and trackers, see safe_scrape.ResourcePolicy
+block_resources = True
+
+async def extract_details(page):
+    # page is already on a car-details url, returns the spec table as a dict
+    car_dict = {}
+
+    await page.wait_for_selector('.data-table__row', state='visible', timeout=30000)
+    
+    data_table = await page.query_selector_all('.data-table__row')
+    
+    # Check if data_table is actually empty
+    if not data_table:
+        print("No data table rows found")
+        return car_dict
+    
+    for items in data_table:
+        # Use .text_content() instead of .get_attribute()
+        title = await items.query_selector('p')
+        item = await items.query_selector('span')
+        
+        # Check if both elements exist before accessing their text
+        if title and item:
+            title_text = await title.text_content()
+            item_text = await item.text_content()
+            
+            # Clean up the text (remove extra whitespace)
+            title_text = title_text.strip().lower().replace(' ', '_')
+            item_text = item_text.strip().lower()
+            
+            # Only add non-empty entries
+            if title_text and item_text:
+                car_dict[title_text] = item_text
+    return car_dict
+
+
 async def run(url):
     async with async_playwright() as playwright:
         browser = await playwright.chromium.launch(headless=False)
@@ -29,6 +65,7 @@ async def run(url):
                 locale='en-US',
                 timezone_id='America/New_York'
             )
+        policy = await ss.apply_resource_policy(context) if block_resources else None
         page = await context.new_page()
         await page.goto(url, timeout=60000, wait_until='load')
         
@@ -36,34 +73,7 @@ async def run(url):
 
         
         try:
-            await page.wait_for_selector('.data-table__row', state='visible', timeout=30000)
-            
-            data_table = await page.query_selector_all('.data-table__row')
-            
-            # Check if data_table is actually empty
-            if not data_table:
-                print("No data table rows found")
-                await browser.close()
-                return car_dict
-            
-            for items in data_table:
-                # Use .text_content() instead of .get_attribute()
-                title = await items.query_selector('p')
-                item = await items.query_selector('span')
-                
-                # Check if both elements exist before accessing their text
-                if title and item:
-                    title_text = await title.text_content()
-                    item_text = await item.text_content()
-                    
-                    # Clean up the text (remove extra whitespace)
-                    title_text = title_text.strip().lower().replace(' ', '_')
-                    item_text = item_text.strip().lower()
-                    
-                    # Only add non-empty entries
-                    if title_text and item_text:
-                        car_dict[title_text] = item_text
-            
+            car_dict = await extract_details(page)
             print(car_dict)
         
         except Exception as e:
@@ -71,5 +81,10 @@ async def run(url):
         
         finally:
             await browser.close()
+            if policy:
+                print(f"Resource policy: {policy.report()}")
+
+        return car_dict
 
-asyncio.run(run(url))
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(run(url))
\ No newline at end of file
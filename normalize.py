@@ -0,0 +1,107 @@
+"""Column-at-a-time cleaning of price, mileage, year, color and names.
+
+Takes a batch of records (or a table read back from the database) as
+pandas columns and returns typed columns, so the rules run as a few
+vectorized regex passes instead of per record string juggling.
+"""
+import re
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+NUMBER_PATTERN = r'(?P<number>\d[\d,]*(?:\.\d+)?)'
+MILEAGE_PATTERN = r'^\s*(?P<number>\d[\d,]*(?:\.\d+)?)\s*(?P<unit>km|k)?\b'
+YEAR_PATTERN = r'(?P<before>Before\s+1980)|(?P<year>\d{4})'
+
+# the sites' "Before 1980" bucket is stored as this year
+BEFORE_1980 = 1970
+MIN_YEAR = 1900
+# more than this is a typo or a phone number, not a mileage
+MAX_MILEAGE = 1_000_000
+# prices posted in thousands of KWD ('12.5', '45')
+THOUSANDS_PRICE = (10, 100)
+
+
+def _strings(values):
+    # object columns keep None, everything else becomes its text
+    values = pd.Series(values, dtype=object)
+    return values.where(values.isna(), values.astype(str))
+
+
+def _to_float(numbers):
+    return pd.to_numeric(numbers.str.replace(',', '', regex=False), errors='coerce').astype('float64')
+
+
+def _year(parts):
+    year = pd.to_numeric(parts['year'], errors='coerce')
+    year = year.where(parts['before'].isna(), BEFORE_1980)
+    year = year.where(year.between(MIN_YEAR, datetime.now().year + 1))
+    return year.astype('Int64')
+
+
+def _mileage(parts, years=None):
+    # 'k' means thousands, a bare number under 1000 on a used car is too
+    mileage = _to_float(parts['number']).to_numpy()
+    in_thousands = parts['unit'].str.lower().eq('k').fillna(False).to_numpy(dtype=bool)
+    if years is not None:
+        years = pd.Series(years, index=parts.index).astype('float64').to_numpy()
+        used = ~(years >= datetime.now().year)
+        in_thousands = in_thousands | (mileage > 0) & (mileage < 1000) & used
+    mileage = np.where(in_thousands, mileage * 1000, mileage)
+    mileage[~((mileage >= 0) & (mileage <= MAX_MILEAGE))] = np.nan
+    return pd.Series(mileage, index=parts.index)
+
+
+def normalize_price(values):
+    values = _strings(values)
+    price = _to_float(values.str.extract(NUMBER_PATTERN)['number']).to_numpy()
+    in_thousands = (price >= THOUSANDS_PRICE[0]) & (price <= THOUSANDS_PRICE[1])
+    return pd.Series(np.where(in_thousands, price * 1000, price), index=values.index)
+
+
+def normalize_year(values):
+    return _year(_strings(values).str.extract(YEAR_PATTERN, flags=re.IGNORECASE))
+
+
+def normalize_mileage(values, years=None):
+    # years turns on the 4sale rule for bare numbers under 1000, only meant for raw 4sale
+    # properties text; mileages that were already parsed are read as they are
+    return _mileage(_strings(values).str.extract(MILEAGE_PATTERN, flags=re.IGNORECASE), years)
+
+
+def normalize_color(values):
+    color = _strings(values).str.strip().str.title()
+    # a leftover mileage or an empty string is not a color
+    return color.where(color.str.contains(r'^\D+$', na=False), None)
+
+
+def normalize_name(values):
+    # the form brand, model and color names are looked up in: single spaced, lower case;
+    # NAME_KEY in insert_into_db is the same rule in SQL
+    names = _strings(values).str.split().str.join(' ').str.lower()
+    return names.where(names.ne('') & names.notna(), None)
+
+
+def normalize_frame(frame):
+    # re-cleans the scraped columns of a table of records in place
+    if 'year' in frame:
+        frame['year'] = normalize_year(frame['year'])
+    if 'mileage' in frame:
+        frame['mileage'] = normalize_mileage(frame['mileage'])
+    if 'price' in frame:
+        frame['price'] = normalize_price(frame['price'])
+    if 'color' in frame:
+        frame['color'] = normalize_color(frame['color'])
+    return frame
+
+
+def to_records(frame):
+    # plain dicts for the JSON Lines sink, missing values become None
+    names = list(frame.columns)
+    columns = []
+    for name in names:
+        missing = frame[name].isna().tolist()
+        values = frame[name].astype(object).tolist()
+        columns.append([None if is_missing else value for value, is_missing in zip(values, missing)])
+    return [dict(zip(names, row)) for row in zip(*columns)]
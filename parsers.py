@@ -0,0 +1,382 @@
+"""Parsing of listing cards and pages, kept free of Playwright.
+
+Every function takes raw strings, dicts or html and returns plain records,
+so the same code runs behind the browser scrapers, the http engine, the
+html archive re-parse and the benchmarks in benchmarks/.
+"""
+import re
+import uuid
+from datetime import datetime
+from typing import List, Optional, TypedDict, Union
+from urllib.parse import urlparse
+
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:  # only needed by the html functions
+    HTMLParser = None
+
+
+class CarRecord(TypedDict):
+    uuid: str
+    url: Optional[str]
+    brand: str
+    page: int
+    timestamp: str
+    model: str
+    year: Union[int, str, None]
+    mileage: Union[float, str, None]
+    color: Optional[str]
+    price: Union[float, str, None]
+
+
+# /en/listing/<slug>-<ad id> on 4sale, /en/car-details/<slug>/<ad id> on motorgy
+AD_ID = re.compile(r'(\d+)/?$')
+# fixed, so listing_uuid gives the same uuid on every machine and every run
+LISTING_NAMESPACE = uuid.UUID('6f1c2b0e-8d4a-5b7e-9c3f-2a1d4e5b6c7d')
+
+
+# path prefix of the listing links each site's scrapes store
+SITE_PATHS = {
+    '/en/listing/': 'q84sale',
+    '/en/car-details/': 'motorgy',
+}
+
+
+def url_site(url):
+    # 'q84sale' or 'motorgy' for a listing url, None for anything else
+    path = urlparse(url).path if url else ''
+    for prefix, site in SITE_PATHS.items():
+        if path.startswith(prefix):
+            return site
+    return None
+
+
+def listing_id(site, url):
+    # the site's own ad id, or the url path when it has none
+    if not url:
+        return None
+    path = urlparse(url).path.rstrip('/')
+    match = AD_ID.search(path)
+    return f'{site}:{match.group(1) if match else path}'
+
+
+def listing_uuid(site, url):
+    # stable across scrapes so a listing seen again updates its row, uuid4 without a url
+    key = listing_id(site, url)
+    return str(uuid.uuid5(LISTING_NAMESPACE, key)) if key else str(uuid.uuid4())
+
+
+def parse_html(html):
+    if HTMLParser is None:
+        raise ImportError('parsing html needs the selectolax package')
+    return HTMLParser(html)
+
+
+# --- shared helpers
+
+def extract_number(text):
+    try:
+        if text is None:
+            return None
+        else:
+        # Split and take first part, replace comma with dot
+            cleaned = text.replace(',', '').split()[0]
+            return float(cleaned)
+    except (ValueError, IndexError):
+        return None
+
+def is_two_digits(number):
+    try:
+        if number is None:
+            return None
+        else:
+            abs_num = abs(number)
+            # Check if between 100 and 999
+            return 10 <= abs_num <= 100
+    except (ValueError, IndexError):
+        return None
+
+
+
+def mileage_processor(mileage):
+    if mileage is None:
+        return False, None
+    
+    # First try to match number followed by standalone 'k'
+    k_pattern = r'(\d+(?:\.\d+)?)\s*\b[kK]\b'
+    k_match = re.search(k_pattern, mileage)
+    
+    if k_match:
+        return 'k', float(k_match.group(1))
+    
+    # If no 'k' match, try to match number followed by 'km'
+    km_pattern = r'(\d+(?:\.\d+)?)\s*(?:km|KM|Km|kM)'
+    km_match = re.search(km_pattern, mileage)
+    
+    if km_match:
+        return 'km', float(km_match.group(1))
+    
+    # If no 'k' or 'km' match, try to match just a number
+    number_pattern = r'^\s*(\d+(?:\.\d+)?)\s*$'
+    number_match = re.search(number_pattern, mileage)
+    
+    if number_match:
+        return False, float(number_match.group(1))
+    
+    return False, None
+
+
+# --- 4sale
+
+def parse_4sale_card(card, brand, page_num, timestamp=None) -> Optional[CarRecord]:
+    # card holds the raw strings of one listing card, see extract_4sale_cards
+    # and CARD_FIELDS_JS in 4sale.py; returns None for cards without properties
+    model = card.get('model') or 'NA'
+    car_properties = card.get('properties') or 'NA'
+    price = card.get('price') or 'NA'
+    link = card.get('url')
+
+    if len(car_properties.split(',')) > 1 and len(car_properties.split(',')) < 4:
+        has_k, mileage_proc = mileage_processor(car_properties.split(',')[1].strip().replace(',', ''))
+    elif len(car_properties.split(',')) == 4:
+        has_k, mileage_proc = mileage_processor(car_properties.split(',')[1].strip().replace(',', '') + car_properties.split(',')[2].strip().replace(',', ''))
+    else:
+        return None
+    
+    year_text = car_properties.split(',')[0].strip()
+    year_value = 1970 if year_text == 'Before 1980' else year_text
+
+    if has_k == 'k' or (has_k == 'km' and len(str(mileage_proc)) == 4  
+                                            and datetime.now().year - int(year_value) > 0):
+        mileage = mileage_proc * 1000
+    elif has_k == 'k' or (has_k == 'km' and int(mileage_proc)/1000 < 1000
+                                            and datetime.now().year - int(year_value) > 0):
+        mileage = mileage_proc * 100
+    else:
+        mileage = None
+        #mileage = mileage.split(',')[1].strip().replace(',', '')
+
+    timestamp = timestamp or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    if is_two_digits(extract_number(price)) is None:
+        price = None
+    elif is_two_digits(extract_number(price)):
+        price = extract_number(price) * 1000
+    else:
+        price = extract_number(price)
+
+
+    if len(car_properties.split(',')) == 3:
+        color = car_properties.split(',')[2].strip()
+    elif len(car_properties.split(',')) == 2:
+        color = car_properties.split(',')[1].strip()
+    elif len(car_properties.split(',')) == 1:
+        color = None
+    else:
+        color = car_properties.split(',')[3].strip()
+    
+    car_info = {
+        'uuid': listing_uuid('q84sale', link),
+        'url': link,
+        'brand': brand,
+        'page': page_num,
+        'timestamp': timestamp,
+        'model': model.strip(),
+        'year': year_value, #year.split(',')[0].strip(),
+        'mileage': mileage,
+        'color': color,#car_properties.split(',')[2].strip(),
+        'price': price #extract_number(price) #extract_number(price) * 1000 if isinstance(extract_number(price), float) else extract_number(price)
+    }
+    return car_info
+
+
+def extract_4sale_cards(html) -> List[dict]:
+    # same raw fields as CARD_FIELDS_JS in 4sale.py, read from page html
+    cards = []
+    for card in parse_html(html).css('.StackedCard_card__Kvggc'):
+        model = card.css_first('.text-6-med.text-neutral_600')
+        properties = card.css_first('.styles_attr___ur_q')
+        price = card.css_first('.h6.text-prim_4sale_500')
+        cards.append({
+            'model': model.text() if model else None,
+            'properties': properties.text() if properties else None,
+            'price': price.text() if price else None,
+            'url': card.attributes.get('href'),
+        })
+    return cards
+
+
+def parse_4sale_page(html, brand, page_num, timestamp=None) -> List[CarRecord]:
+    return [car_info for car_info in (parse_4sale_card(card, brand, page_num, timestamp)
+                                      for card in extract_4sale_cards(html))
+            if car_info is not None]
+
+
+# candidate keys for each field of a listing in the payload, first match wins
+LISTING_FIELDS = {
+    'id': ('id', 'user_adv_id', 'adv_id'),
+    'slug': ('slug',),
+    'url': ('url', 'link', 'share_link'),
+    'model': ('title', 'name', 'model'),
+    'year': ('year', 'model_year', 'manufacture_year'),
+    'mileage': ('mileage', 'kilometers', 'km'),
+    'color': ('color', 'colour', 'exterior_color'),
+    'price': ('price',),
+}
+
+def find_listings(data):
+    # walks the payload and returns the first list that looks like listing records
+    if isinstance(data, list):
+        dicts = [item for item in data if isinstance(item, dict)]
+        listings = [d for d in dicts if 'price' in d and ('id' in d or 'slug' in d)]
+        if listings and len(listings) >= len(dicts) / 2:
+            return listings
+        children = data
+    elif isinstance(data, dict):
+        children = data.values()
+    else:
+        return []
+
+    for child in children:
+        found = find_listings(child)
+        if found:
+            return found
+    return []
+
+
+def flatten_listing(listing):
+    # attributes come either as nested dicts or as [{'name': ..., 'value': ...}] lists
+    flat = {}
+    for key, value in listing.items():
+        if isinstance(value, dict):
+            for k, v in value.items():
+                flat.setdefault(str(k).lower(), v)
+        elif isinstance(value, list) and value and all(isinstance(v, dict) for v in value):
+            for v in value:
+                name = v.get('name') or v.get('label') or v.get('key')
+                if name and 'value' in v:
+                    flat.setdefault(str(name).strip().lower().replace(' ', '_'), v['value'])
+    for key, value in listing.items():
+        if not isinstance(value, (dict, list)):
+            flat[str(key).lower()] = value
+    return flat
+
+
+def to_number(value):
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.search(r'\d+(?:\.\d+)?', str(value).replace(',', ''))
+    return float(match.group()) if match else None
+
+
+def parse_4sale_listing(listing, brand, page_num, timestamp=None) -> CarRecord:
+    # listing is one record of the site's own payload, numbers are already exact
+    flat = flatten_listing(listing)
+    fields = {}
+    for field, keys in LISTING_FIELDS.items():
+        fields[field] = next((flat[k] for k in keys if flat.get(k) not in (None, '')), None)
+
+    link = fields['url']
+    if link is None and fields['slug']:
+        slug = str(fields['slug'])
+        link = '/en/listing/' + (slug if str(fields['id']) in slug else f"{slug}-{fields['id']}")
+
+    year = to_number(fields['year'])
+    color = fields['color']
+
+    car_info = {
+        'uuid': listing_uuid('q84sale', link),
+        'url': link,
+        'brand': brand,
+        'page': page_num,
+        'timestamp': timestamp or datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'model': str(fields['model'] or 'NA').strip(),
+        'year': int(year) if year is not None else None,
+        'mileage': to_number(fields['mileage']),
+        'color': color.strip() if isinstance(color, str) else color,
+        'price': to_number(fields['price'])
+    }
+    return car_info
+
+
+# --- motorgy
+
+def parse_motorgy_card(card, page_num, timestamp) -> Optional[CarRecord]:
+    # card holds the raw strings of one listing card, see extract_motorgy_cards
+    # and CARD_FIELDS_JS in motorgy.py; returns None for cards without a title
+    if card.get('name') is None:
+        return None
+
+    split_names = card['name'].split('؜')
+    brand = split_names[0]
+    model = ''.join(split_names[1:]) #split_names[1]
+    mileage = card.get('mileage') or ''
+    price_text = card.get('price') or ''
+
+    car_dict ={
+    'uuid': listing_uuid('motorgy', card.get('url')),
+    'url': card.get('url'),
+    'brand': brand.strip().replace('-', ' '),
+    'page':page_num,
+    'timestamp': timestamp,
+    'model': model.strip().replace('-', ' '),
+    'year': card.get('year'),
+    'mileage': (mileage.strip().replace(',', '').split() or [None])[0],
+    'color':None,
+    'price': (price_text.replace(',', '').split() or [None])[0]
+    }
+    return car_dict
+
+
+def extract_motorgy_cards(html) -> List[dict]:
+    # same raw fields as CARD_FIELDS_JS in motorgy.py, read from page html
+    cards = []
+    for card in parse_html(html).css('.card-body'):
+        title = card.css_first('.card-title .ff-semiBold.fs-16.color_title')
+        year = card.css_first('.feature-cars-year.me-2.ff-semiBold.fs-12.color_title')
+        mileage = card.css_first('.feature-cars-KM.ff-semiBold.me-2.fs-12.color_subtitle')
+        # these are nested tags, the price sits in the last container
+        price_containers = card.css('.d-flex.justify-content-between')
+        price = price_containers[-1].css_first('.color_title.ff-semiBold.fs-16') if price_containers else None
+        cards.append({
+            'name': title.text() if title else None,
+            'url': title.attributes.get('href') if title else None,
+            'year': year.text() if year else None,
+            'mileage': mileage.text() if mileage else None,
+            'price': price.text() if price else None,
+        })
+    return cards
+
+
+def parse_motorgy_page(html, page_num, timestamp) -> List[CarRecord]:
+    return [car_dict for car_dict in (parse_motorgy_card(card, page_num, timestamp)
+                                      for card in extract_motorgy_cards(html))
+            if car_dict is not None]
+
+
+def motorgy_last_page(html) -> Optional[int]:
+    # same rule as motorgy.last_page_number: the last active link has the highest pn=
+    tree = parse_html(html)
+    if tree.css_first('#pagingDiv') is None:
+        return None
+    active_links = tree.css('a.activeLink')
+    href = active_links[-1].attributes.get('href') if active_links else None
+    if not href or 'pn=' not in href:
+        return None
+    return int(href.split('pn=')[1])
+
+
+def parse_motorgy_details(html) -> dict:
+    # same dict as motorgy_internal.extract_details
+    car_dict = {}
+    for row in parse_html(html).css('.data-table__row'):
+        title = row.css_first('p')
+        item = row.css_first('span')
+        if title and item:
+            title_text = title.text().strip().lower().replace(' ', '_')
+            item_text = item.text().strip().lower()
+            if title_text and item_text:
+                car_dict[title_text] = item_text
+    return car_dict
@@ -0,0 +1,130 @@
+import argparse
+import logging
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# car_scrapes keeps one row per listing per scrape in a partition per month ('month')
+# or per day ('day'); partitions older than retention_days become daily_market rows
+partition_interval = 'month'
+retention_days = 90
+# serializes partition creation between parallel loaders
+PARTITION_LOCK = 7240024
+
+PREFIX = {'month': 'car_scrapes_m', 'day': 'car_scrapes_d'}
+NAME_FORMAT = {'month': '%Y%m', 'day': '%Y%m%d'}
+
+# daily_market has one row per day/brand/model/year, a day loaded again after its
+# partition was rolled up is merged in: counts add up, medians are weighted by scrapes
+ROLLUP_QUERY = '''
+    INSERT INTO daily_market (day, brand_id, model_id, year, listings, scrapes,
+                              median_price, median_mileage, min_price, max_price)
+    SELECT timestamp::date, coalesce(brand_id, 0), coalesce(model_id, 0), coalesce(year, 0),
+        count(DISTINCT uuid), count(*),
+        percentile_cont(0.5) WITHIN GROUP (ORDER BY price),
+        percentile_cont(0.5) WITHIN GROUP (ORDER BY mileage),
+        min(price), max(price)
+    FROM {partition}
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (day, brand_id, model_id, year) DO UPDATE SET
+        listings = daily_market.listings + excluded.listings,
+        scrapes = daily_market.scrapes + excluded.scrapes,
+        median_price = (daily_market.median_price * daily_market.scrapes + excluded.median_price * excluded.scrapes)
+            / (daily_market.scrapes + excluded.scrapes),
+        median_mileage = (daily_market.median_mileage * daily_market.scrapes
+                          + excluded.median_mileage * excluded.scrapes) / (daily_market.scrapes + excluded.scrapes),
+        min_price = least(daily_market.min_price, excluded.min_price),
+        max_price = greatest(daily_market.max_price, excluded.max_price)'''
+
+_created = set()
+
+
+def partition_start(moment, interval=partition_interval):
+    if interval == 'month':
+        return date(moment.year, moment.month, 1)
+    return date(moment.year, moment.month, moment.day)
+
+
+def partition_end(start, interval=partition_interval):
+    if interval == 'month':
+        return date(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start + timedelta(days=1)
+
+
+def partition_name(start, interval=partition_interval):
+    return PREFIX[interval] + start.strftime(NAME_FORMAT[interval])
+
+
+def parse_partition(name):
+    # (start, end) of a partition from its name, None for tables that aren't ours
+    for interval, prefix in PREFIX.items():
+        if name.startswith(prefix):
+            start = datetime.strptime(name[len(prefix):], NAME_FORMAT[interval]).date()
+            return start, partition_end(start, interval)
+    return None
+
+
+def ensure_partitions(engine, timestamps):
+    # creates the partitions a batch of scrape timestamps falls into, once per process
+    moments = pd.to_datetime(pd.Series(list(timestamps), dtype=object), errors='coerce', format='ISO8601').dropna()
+    starts = {partition_start(moment) for moment in moments.dt.normalize().unique()} - _created
+    if not starts:
+        return
+    with engine.begin() as connection:
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': PARTITION_LOCK})
+        for start in sorted(starts):
+            connection.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {partition_name(start)} PARTITION OF car_scrapes "
+                f"FOR VALUES FROM ('{start}') TO ('{partition_end(start)}')"))
+    _created.update(starts)
+
+
+def list_partitions(connection):
+    rows = connection.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'car_scrapes' ORDER BY c.relname"))
+    return [row[0] for row in rows]
+
+
+def apply_retention(engine, days=retention_days):
+    # rolls every partition that ended before the retention window into daily_market and drops it
+    cutoff = date.today() - timedelta(days=days)
+    with engine.connect() as connection:
+        names = list_partitions(connection)
+    dropped = 0
+    for name in names:
+        bounds = parse_partition(name)
+        if bounds is None or bounds[1] > cutoff:
+            continue
+        started = datetime.now()
+        # one transaction per partition: its rollup and its drop happen together or not at all
+        with engine.begin() as connection:
+            connection.execute(text(f'ALTER TABLE car_scrapes DETACH PARTITION {name}'))
+            groups = connection.execute(text(ROLLUP_QUERY.format(partition=name))).rowcount
+            connection.execute(text(f'DROP TABLE {name}'))
+        _created.discard(bounds[0])
+        dropped += 1
+        logger.info(f"Rolled {name} up into {groups} daily_market rows and dropped it "
+                    f"in {(datetime.now() - started).total_seconds():.1f}s")
+    logger.info(f"{dropped} partitions older than {cutoff} rolled up, {len(names) - dropped} kept")
+    return dropped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Partitions of the car_scrapes history')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    retain = subparsers.add_parser('retain', help='roll up and drop partitions older than the retention window')
+    retain.add_argument('--days', type=int, default=retention_days)
+    subparsers.add_parser('list', help='partitions and their date ranges')
+    args = parser.parse_args()
+
+    import insert_into_db as db
+    if args.command == 'retain':
+        apply_retention(db.engine, args.days)
+    else:
+        with db.engine.connect() as connection:
+            for name in list_partitions(connection):
+                print(name, *(parse_partition(name) or ()))
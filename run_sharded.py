@@ -0,0 +1,174 @@
+from playwright.async_api import async_playwright
+import argparse
+import asyncio
+import importlib
+import logging
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import safe_scrape as ss
+from crawl_queue import run_task
+from scrape_sink import JsonlSink, remove_run_info
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('run_sharded_log.log'),
+        logging.StreamHandler()
+    ]
+)
+
+logger = logging.getLogger(__name__)
+
+headless = True
+
+
+def plan_shards(brands, motorgy_pages, processes):
+    # 4sale brands dealt round robin, motorgy cut into one contiguous page range per process;
+    # a task is the same dict crawl_queue hands to its workers
+    shards = [[] for _ in range(processes)]
+    for i, brand in enumerate(brands):
+        shards[i % processes].append({'site': 'q84sale', 'brand': brand, 'first_page': 1, 'last_page': None})
+    if motorgy_pages:
+        pages_per_shard = math.ceil(motorgy_pages / processes)
+        for i, first_page in enumerate(range(1, motorgy_pages + 1, pages_per_shard)):
+            shards[i].append({'site': 'motorgy', 'brand': 'all', 'first_page': first_page,
+                              'last_page': min(first_page + pages_per_shard - 1, motorgy_pages)})
+    return [shard for shard in shards if shard]
+
+
+async def motorgy_page_count():
+    motorgy = importlib.import_module('motorgy')
+    async with async_playwright() as playwright:
+        browser = await playwright.chromium.launch(headless=headless)
+        try:
+            page = await browser.new_page(user_agent=motorgy.user_agent, locale='en-US')
+            await ss.apply_resource_policy(page)
+            await ss.goto(page, motorgy.url)
+            return await motorgy.last_page_number(page)
+        finally:
+            await browser.close()
+
+
+def disable_concurrency():
+    # one brand and one tab at a time inside the process, the pool is the only parallelism
+    fsale = importlib.import_module('4sale')
+    motorgy = importlib.import_module('motorgy')
+    fsale.max_concurrency = 1
+    for module in (fsale, motorgy):
+        module.page_concurrency = 1
+        module.max_page_concurrency = 1
+
+
+async def scrape_shard(shard, filename, compression):
+    fsale = importlib.import_module('4sale')
+    semaphore = asyncio.Semaphore(fsale.max_concurrency)
+    summary = {'tasks': len(shard), 'failed': 0}
+
+    async def scrape_task(browser, task, sink):
+        async with semaphore:
+            try:
+                await run_task(browser, task, sink)
+            except Exception as e:
+                # the other tasks of the shard keep going
+                summary['failed'] += 1
+                sink.mark_incomplete(f"{task['site']} {task['brand']} pages {task['first_page']}-"
+                                     f"{task['last_page'] or 'end'} failed: {e}")
+                logger.error('%s %s pages %d-%s failed: %s', task['site'], task['brand'], task['first_page'],
+                             task['last_page'] or 'end', e, exc_info=True)
+
+    with JsonlSink(filename, compression=compression) as sink:
+        async with async_playwright() as playwright:
+            browser = await playwright.chromium.launch(headless=headless)
+            try:
+                await asyncio.gather(*(scrape_task(browser, task, sink) for task in shard))
+            finally:
+                await browser.close()
+    summary['records'] = sink.records_written
+    summary['file'] = sink.filename
+    return summary
+
+
+def run_shard(index, shard, filename, compression, concurrency):
+    # entry point of every worker process: its own event loop and browser
+    if not concurrency:
+        disable_concurrency()
+    started = datetime.now()
+    summary = asyncio.run(scrape_shard(shard, filename, compression))
+    summary['shard'] = index
+    summary['elapsed'] = (datetime.now() - started).total_seconds()
+    logger.info('Shard %d done: %d records from %d tasks (%d failed) in %.0fs', index, summary['records'],
+                summary['tasks'], summary['failed'], summary['elapsed'])
+    return summary
+
+
+def run(output, processes=None, sites=('q84sale', 'motorgy'), motorgy_pages=None, compression=None,
+        concurrency=True):
+    processes = processes or os.cpu_count()
+    started = datetime.now()
+    brands = list(importlib.import_module('4sale').cars_dict) if 'q84sale' in sites else []
+    skipped = None
+    if 'motorgy' in sites and not motorgy_pages:
+        try:
+            motorgy_pages = asyncio.run(motorgy_page_count())
+        except Exception as e:
+            logger.error('Could not read the motorgy page count: %s', e, exc_info=True)
+        if not motorgy_pages:
+            # without the page count there are no ranges to shard, motorgy is left out of this run
+            skipped = 'motorgy skipped, its page count could not be read'
+            logger.error('No motorgy page count, leaving motorgy out of the run')
+    shards = plan_shards(brands, motorgy_pages if 'motorgy' in sites else None, processes)
+    if not shards:
+        raise RuntimeError(skipped or 'nothing to scrape')
+    logger.info('%d brands and %s motorgy pages over %d processes', len(brands), motorgy_pages or 'no',
+                len(shards))
+
+    # spawn gives every process a clean interpreter for its own event loop and browser
+    context = multiprocessing.get_context('spawn')
+    summaries = []
+    with ProcessPoolExecutor(max_workers=len(shards), mp_context=context) as pool:
+        futures = [pool.submit(run_shard, i, shard, f'{output}.shard{i}', compression, concurrency)
+                   for i, shard in enumerate(shards)]
+        for i, future in enumerate(futures):
+            try:
+                summaries.append(future.result())
+            except Exception as e:
+                logger.error('Shard %d crashed: %s', i, e)
+
+    # the shard files are concatenated as they are into one output, together
+    # the shards cover every page, unless one of them missed some or crashed
+    with JsonlSink(output, compression=compression) as sink:
+        for summary in summaries:
+            sink.append_file(summary['file'], summary['records'])
+            os.remove(summary['file'])
+            remove_run_info(summary['file'])
+        if len(summaries) < len(shards):
+            sink.mark_incomplete(f'{len(shards) - len(summaries)} shards crashed')
+        if skipped:
+            sink.mark_incomplete(skipped)
+
+    elapsed = (datetime.now() - started).total_seconds()
+    failed = sum(summary['failed'] for summary in summaries)
+    logger.info('Run done: %d records from %d shards (%d crashed, %d failed tasks) in %.0fs (%.0f/hour), written to %s',
+                sink.records_written, len(shards), len(shards) - len(summaries), failed, elapsed,
+                sink.records_written / elapsed * 3600 if elapsed else 0, sink.filename)
+    return {'records': sink.records_written, 'shards': summaries, 'elapsed': elapsed, 'file': sink.filename}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Scrape 4sale brands and motorgy pages on a pool of processes')
+    parser.add_argument('--output', default=f"car_list_{datetime.now().strftime('%Y%m%d')}.jsonl")
+    parser.add_argument('--processes', type=int, help='defaults to every core')
+    parser.add_argument('--site', action='append', choices=['q84sale', 'motorgy'], help='both by default')
+    parser.add_argument('--motorgy-pages', type=int, help='motorgy page count, looked up when not given')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'])
+    parser.add_argument('--no-concurrency', action='store_true',
+                        help='one brand and one tab at a time in every process')
+    args = parser.parse_args()
+
+    run(args.output, args.processes, tuple(args.site or ('q84sale', 'motorgy')), args.motorgy_pages,
+        args.compression, concurrency=not args.no_concurrency)
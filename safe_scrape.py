@@ -1,5 +1,10 @@
+import asyncio
+import logging
 import random
+import time
+from urllib.parse import urlparse
 
+logger = logging.getLogger(__name__)
 
 
 def random_delay(min, max):
@@ -19,4 +24,255 @@ def random_mouse_movement():
 
 
 def exp_wait_time(attempt):
-    return (2 ** attempt) * 10
\ No newline at end of file
+    return (2 ** attempt) * 10
+
+
+class HostRateLimiter:
+    """Token bucket per host, shared by every coroutine hitting the same site.
+
+    Waiting happens with asyncio.sleep so the event loop keeps serving the
+    other pages while one of them is being polite.
+    """
+
+    def __init__(self, rate=0.5, burst=1, jitter=(1.5, 3)):
+        # rate = requests per second allowed per host
+        # burst = how many requests can go out back to back
+        # jitter = extra random delay (seconds) added after each token
+        self.rate = rate
+        self.burst = burst
+        self.jitter = jitter
+        self._buckets = {}
+        self._locks = {}
+
+    def _host(self, url):
+        return urlparse(url).netloc or url
+
+    async def acquire(self, url):
+        host = self._host(url)
+        lock = self._locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            tokens, last = self._buckets.get(host, (self.burst, time.monotonic()))
+            now = time.monotonic()
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                await asyncio.sleep((1 - tokens) / self.rate)
+                now = time.monotonic()
+                tokens = 1
+            self._buckets[host] = (tokens - 1, now)
+        # jitter is outside the lock so it does not hold back the other workers
+        await asyncio.sleep(random_delay(*self.jitter))
+
+
+# one budget per site for the whole process
+limiter = HostRateLimiter()
+
+
+async def human_pause(page, rate_limiter=None):
+    """Move the mouse around like a person would, then wait for the host's turn."""
+    rate_limiter = rate_limiter or limiter
+    x, y = random_mouse_movement()
+    await page.mouse.move(x, y)
+    await asyncio.sleep(random.randint(300, 800) / 1000)
+    await rate_limiter.acquire(page.url)
+
+
+class Throttled(Exception):
+    """The site pushed back: 429/403 or a block page instead of listings."""
+
+
+class EmptyPage(Exception):
+    """The page loaded but had none of the content we came for."""
+
+
+# status codes the sites answer with when we go too fast
+THROTTLE_STATUSES = (403, 429)
+# playwright, asyncio and httpx all have their own timeout classes
+TIMEOUT_ERRORS = ('TimeoutError', 'TimeoutException')
+
+
+def check_response(response):
+    # response is what page.goto() returned, None for same-document navigations
+    if response is not None and response.status in THROTTLE_STATUSES:
+        raise Throttled(f'{response.url} answered {response.status}')
+    return response
+
+
+async def goto(page, url, timeout=60000):
+    # waits for the host's turn, then navigates and fails fast on a throttled answer
+    await limiter.acquire(url)
+    return check_response(await page.goto(url, timeout=timeout, wait_until='load'))
+
+
+def classify_error(error):
+    # 'throttled', 'timeout', 'empty' or 'error'
+    if isinstance(error, Throttled):
+        return 'throttled'
+    if isinstance(error, EmptyPage):
+        return 'empty'
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status in THROTTLE_STATUSES:
+        return 'throttled'
+    if any(cls.__name__ in TIMEOUT_ERRORS for cls in type(error).__mro__):
+        return 'timeout'
+    return 'error'
+
+
+def backoff_delay(attempt, kind='error'):
+    # exp_wait_time with jitter, a throttled site gets one step more
+    ceiling = exp_wait_time(attempt + 1 if kind == 'throttled' else attempt)
+    return random.uniform(ceiling / 2, ceiling)
+
+
+class AdaptiveConcurrency:
+    """Concurrency limit that adapts to the site, additive increase / multiplicative decrease.
+
+    Every increase_every successes in a row allow one more request in
+    flight, a timeout or a throttled answer halves the limit. Failures of
+    requests that were already in flight when the limit was cut (within
+    cooldown seconds) don't cut it again.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=None, increase_every=10, cooldown=5):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum or initial * 2
+        self.increase_every = increase_every
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._successes = 0
+        self._last_decrease = None
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        self._successes += 1
+        if self._successes >= self.increase_every and self.limit < self.maximum:
+            self.limit += 1
+            self._successes = 0
+            logger.info('Site is healthy, concurrency up to %d', self.limit)
+
+    def on_failure(self, kind):
+        self._successes = 0
+        if kind not in ('throttled', 'timeout') or self.limit <= self.minimum:
+            return
+        now = time.monotonic()
+        if self._last_decrease is None or now - self._last_decrease >= self.cooldown:
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit // 2)
+            logger.warning('Site is pushing back (%s), concurrency down to %d', kind, self.limit)
+
+
+async def with_retries(func, retries=3, concurrency=None, description='request'):
+    # func is called again for every attempt, the backoff is slept outside
+    # the concurrency slot so the other requests keep going meanwhile
+    for attempt in range(retries + 1):
+        try:
+            if concurrency is None:
+                return await func()
+            async with concurrency:
+                result = await func()
+            concurrency.on_success()
+            return result
+        except Exception as e:
+            kind = classify_error(e)
+            if concurrency is not None:
+                concurrency.on_failure(kind)
+            if attempt == retries:
+                raise
+            delay = backoff_delay(attempt, kind)
+            logger.warning('%s failed (%s: %s), attempt %d of %d, retrying in %.0fs',
+                           description, kind, e, attempt + 1, retries + 1, delay)
+            await asyncio.sleep(delay)
+
+
+# resource types none of the extraction code reads
+BLOCKED_RESOURCE_TYPES = ('image', 'font', 'media')
+
+# analytics, ads and tracking pixels loaded by the listing sites
+TRACKER_DOMAINS = (
+    'google-analytics.com',
+    'googletagmanager.com',
+    'googlesyndication.com',
+    'googleadservices.com',
+    'doubleclick.net',
+    'adservice.google.com',
+    'connect.facebook.net',
+    'analytics.tiktok.com',
+    'snap.licdn.com',
+    'hotjar.com',
+    'clarity.ms',
+    'criteo.com',
+    'segment.io',
+    'mixpanel.com',
+)
+
+# rough transfer size per blocked request, only used to estimate the savings
+ESTIMATED_BYTES = {
+    'image': 60_000,
+    'font': 30_000,
+    'media': 500_000,
+    'script': 40_000,
+}
+
+
+class ResourcePolicy:
+    """Allow/deny rules for the requests a page makes, applied with route().
+
+    Allow lists win over deny lists, so a domain or type can be let through
+    even when it is blocked by default.
+    """
+
+    def __init__(self, blocked_types=BLOCKED_RESOURCE_TYPES, blocked_domains=TRACKER_DOMAINS,
+                 allowed_types=(), allowed_domains=()):
+        self.blocked_types = set(blocked_types)
+        self.blocked_domains = tuple(blocked_domains)
+        self.allowed_types = set(allowed_types)
+        self.allowed_domains = tuple(allowed_domains)
+        self.blocked = {}
+        self.allowed = 0
+
+    @staticmethod
+    def _matches(host, domains):
+        return any(host == domain or host.endswith('.' + domain) for domain in domains)
+
+    def allows(self, resource_type, url):
+        host = urlparse(url).hostname or ''
+        if resource_type in self.allowed_types or self._matches(host, self.allowed_domains):
+            return True
+        return resource_type not in self.blocked_types and not self._matches(host, self.blocked_domains)
+
+    async def handle(self, route):
+        request = route.request
+        if self.allows(request.resource_type, request.url):
+            self.allowed += 1
+            await route.continue_()
+        else:
+            self.blocked[request.resource_type] = self.blocked.get(request.resource_type, 0) + 1
+            await route.abort()
+
+    def report(self):
+        estimated_bytes = sum(ESTIMATED_BYTES.get(resource_type, 10_000) * count
+                              for resource_type, count in self.blocked.items())
+        return {
+            'allowed_requests': self.allowed,
+            'blocked_requests': sum(self.blocked.values()),
+            'blocked_by_type': dict(self.blocked),
+            'estimated_bytes_saved': estimated_bytes,
+        }
+
+
+async def apply_resource_policy(target, policy=None):
+    # target can be a browser context (all its pages) or a single page
+    policy = policy or ResourcePolicy()
+    await target.route('**/*', policy.handle)
+    return policy
@@ -0,0 +1,248 @@
+import asyncio
+import gzip
+import io
+import json
+import os
+import shutil
+from datetime import datetime
+from itertools import islice
+
+try:
+    import zstandard
+except ImportError:  # only needed for .zst output
+    zstandard = None
+
+try:
+    import ijson
+except ImportError:  # legacy .json files are then loaded whole
+    ijson = None
+
+
+COMPRESSION_SUFFIX = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+class JsonlSink:
+    """Append-only JSON Lines writer, one record per line.
+
+    Records go to '<filename>.part' while the run is going and every page is
+    flushed and fsynced, so a crash loses at most the page being written.
+    Compressed pages are written as their own gzip member or zstd frame, so
+    the file is readable (and can be appended to) after any page.
+    close() atomically moves the file into place, the output of a previous
+    run with the same name is kept as '<filename>.1'.
+
+    A run picked up from a checkpoint passes resume_bytes/resume_records:
+    the '.part' file is cut back to the last flushed page and appended to.
+
+    Next to the output, '<filename>.run.json' says whether the run covered
+    every page: scrapers call mark_incomplete() for a page they gave up on,
+    an incremental crawl or a page range, and the loader only marks missing
+    listings as removed for a complete run.
+    """
+
+    def __init__(self, filename, compression=None, fsync=True, resume_bytes=None, resume_records=0):
+        if compression not in COMPRESSION_SUFFIX:
+            raise ValueError(f'Unknown compression: {compression}')
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstd compression needs the zstandard package')
+
+        suffix = COMPRESSION_SUFFIX[compression]
+        self.filename = filename if filename.endswith(suffix) else filename + suffix
+        self.part_filename = self.filename + '.part'
+        self.compression = compression
+        self.fsync = fsync
+        self.records_written = resume_records if resume_bytes is not None else 0
+        self._compressor = zstandard.ZstdCompressor() if compression == 'zstd' else None
+        self.incomplete = []
+
+        self._file = open(self.part_filename, 'ab')
+        if resume_bytes is not None:
+            self._file.truncate(resume_bytes)
+            # what the crashed run already knew it had missed
+            self.incomplete = (read_run_info(self.part_filename) or {}).get('incomplete', [])
+        else:
+            if self.bytes_written:
+                # leftover from a run that was not resumed, start clean
+                self._file.truncate(0)
+            remove_run_info(self.part_filename)
+
+    @property
+    def bytes_written(self):
+        return os.fstat(self._file.fileno()).st_size
+
+    def _encode(self, data):
+        if self.compression == 'gzip':
+            return gzip.compress(data)
+        if self.compression == 'zstd':
+            return self._compressor.compress(data)
+        return data
+
+    def write_page(self, records):
+        data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        if data:
+            self._file.write(self._encode(data.encode('utf-8')))
+        self.records_written += len(records)
+        self.flush()
+
+    def append_file(self, filename, records):
+        # copies the output of another sink with the same compression as is,
+        # JSON Lines, gzip members and zstd frames all concatenate
+        with open(filename, 'rb') as f:
+            shutil.copyfileobj(f, self._file, 1024 * 1024)
+        self.records_written += records
+        self.flush()
+        # whatever the other run missed, this one misses too
+        for reason in (read_run_info(filename) or {}).get('incomplete', []):
+            self.mark_incomplete(f'{os.path.basename(filename)}: {reason}')
+
+    def mark_incomplete(self, reason):
+        # kept next to the '.part' file right away, so a resumed run still knows
+        self.incomplete.append(reason)
+        self._write_run_info(self.part_filename)
+
+    def _write_run_info(self, filename):
+        info = {'records': self.records_written, 'complete': not self.incomplete,
+                'incomplete': self.incomplete, 'written_at': datetime.now().isoformat()}
+        with open(run_info_filename(filename), 'w') as f:
+            json.dump(info, f)
+
+    def flush(self):
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self, finished=True):
+        # an unfinished run keeps its '.part' file so it can be resumed
+        if self._file.closed:
+            return self.filename
+        self.flush()
+        self._file.close()
+        if not finished:
+            return self.part_filename
+
+        if os.path.exists(self.filename):
+            os.replace(self.filename, self.filename + '.1')
+            if os.path.exists(run_info_filename(self.filename)):
+                os.replace(run_info_filename(self.filename), run_info_filename(self.filename + '.1'))
+        os.replace(self.part_filename, self.filename)
+        self._write_run_info(self.filename)
+        remove_run_info(self.part_filename)
+        return self.filename
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(finished=exc_type is None)
+
+
+def run_info_filename(filename):
+    return filename + '.run.json'
+
+
+def read_run_info(filename):
+    # None for files from before the sinks wrote run info, or not written by a sink
+    try:
+        with open(run_info_filename(filename)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def remove_run_info(filename):
+    if os.path.exists(run_info_filename(filename)):
+        os.remove(run_info_filename(filename))
+
+
+def open_binary(filename):
+    # a leftover '.part' file is read the same way as the finished one
+    name = filename[:-len('.part')] if filename.endswith('.part') else filename
+    if name.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if name.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('reading .zst files needs the zstandard package')
+        raw = open(filename, 'rb')
+        return zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+    return open(filename, 'rb')
+
+
+def open_text(filename):
+    return io.TextIOWrapper(open_binary(filename), encoding='utf-8')
+
+
+def legacy_prefix(filename):
+    # to_json_file wrote a list of per-run lists, older files a flat list or a single record
+    with open_binary(filename) as f:
+        events = ijson.parse(f)
+        _, first_event, _ = next(events, ('', None, None))
+        if first_event == 'start_map':
+            return ''
+        _, second_event, _ = next(events, ('', None, None))
+        return 'item.item' if second_event == 'start_array' else 'item'
+
+
+def iter_records(filename):
+    # JSON Lines (optionally .gz/.zst) is read line by line, the legacy
+    # to_json_file output is parsed incrementally with ijson, so memory
+    # stays flat however big the file is
+    name = filename[:-len('.part')] if filename.endswith('.part') else filename
+    name = name.rsplit('.', 1)[0] if name.endswith(('.gz', '.zst')) else name
+
+    if name.endswith('.jsonl'):
+        with open_text(filename) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        return
+
+    if ijson is not None:
+        prefix = legacy_prefix(filename)
+        with open_binary(filename) as f:
+            # use_float keeps prices and mileages floats instead of Decimal
+            yield from ijson.items(f, prefix, use_float=True)
+        return
+
+    with open_text(filename) as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = [data]
+    for item in data:
+        if isinstance(item, list):
+            yield from item
+        else:
+            yield item
+
+
+def iter_batches(filename, batch_size):
+    # records in lists of at most batch_size, for loaders that work a batch at a time
+    records = iter_records(filename)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+async def write_pages_in_order(sink, tasks, first_page, on_page=None):
+    # tasks resolve to (page_num, records) in any order, pages are held back
+    # until every page before them is written so the file stays in page order
+    pending = {}
+    next_page = first_page
+    records_written = 0
+    for task in asyncio.as_completed(tasks):
+        page_num, records = await task
+        pending[page_num] = records
+        while next_page in pending:
+            records = pending.pop(next_page)
+            sink.write_page(records)
+            records_written += len(records)
+            if on_page:
+                on_page(next_page)
+            next_page += 1
+    return records_written
@@ -0,0 +1,87 @@
+"""The Playwright-free parsers against the recorded pages in fixtures/."""
+import json
+import os
+import sys
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import parsers
+
+FIXTURES = os.path.join(ROOT, 'fixtures')
+TIMESTAMP = '2025-01-14 08:25:00'
+
+needs_html = pytest.mark.skipif(parsers.HTMLParser is None, reason='selectolax is not installed')
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return json.load(f) if name.endswith('.json') else f.read()
+
+
+@needs_html
+def test_extract_4sale_cards_matches_the_recorded_cards():
+    assert parsers.extract_4sale_cards(fixture('4sale_listing.html')) == fixture('4sale_cards.json')
+
+
+@needs_html
+def test_extract_motorgy_cards_matches_the_recorded_cards():
+    assert parsers.extract_motorgy_cards(fixture('motorgy_listing.html')) == fixture('motorgy_cards.json')
+
+
+@needs_html
+def test_motorgy_last_page():
+    assert parsers.motorgy_last_page(fixture('motorgy_listing.html')) == 57
+
+
+def test_parse_4sale_listing():
+    listings = parsers.find_listings(fixture('4sale_next_data.json'))
+    records = [parsers.parse_4sale_listing(listing, 'toyota', 1, TIMESTAMP) for listing in listings]
+
+    assert len(records) == 4
+    assert records[0] == {
+        'uuid': parsers.listing_uuid('q84sale', '/en/listing/toyota-land-cruiser-2019-18734512'),
+        'url': '/en/listing/toyota-land-cruiser-2019-18734512',
+        'brand': 'toyota',
+        'page': 1,
+        'timestamp': TIMESTAMP,
+        'model': 'Toyota Land Cruiser GXR',
+        'year': 2019,
+        'mileage': 85000.0,
+        'color': 'White',
+        'price': 12750.0,
+    }
+    # a price in thousands of KWD, the "Before 1980" bucket, a listing without a color
+    assert records[1]['price'] == 6500.0
+    assert records[2]['year'] == 1978
+    assert records[3]['color'] is None
+
+
+@needs_html
+def test_parse_motorgy_details():
+    assert parsers.parse_motorgy_details(fixture('motorgy_details.html')) == {
+        'brand': 'dodge',
+        'model': 'charger rt',
+        'year': '2018',
+        'kilometers': '96,410',
+        'exterior_color': 'black',
+        'transmission': 'automatic',
+        'fuel_type': 'petrol',
+        'cylinders': '8',
+    }
+
+
+def test_listing_uuid_is_stable_across_url_forms():
+    relative = parsers.listing_uuid('q84sale', '/en/listing/toyota-camry-2021-18734498')
+    absolute = parsers.listing_uuid('q84sale', 'https://www.q84sale.com/en/listing/toyota-camry-2021-18734498?ref=1')
+
+    assert relative == absolute
+    assert uuid.UUID(relative).version == 5
+    assert parsers.listing_uuid('motorgy', '/en/listing/toyota-camry-2021-18734498') != relative
+
+
+def test_listing_uuid_without_url_is_random():
+    assert parsers.listing_uuid('motorgy', None) != parsers.listing_uuid('motorgy', None)